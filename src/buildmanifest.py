@@ -0,0 +1,121 @@
+# SPDX-License-Identifier: MIT
+import re, plistlib
+from xml.sax.saxutils import escape
+
+# BuildManifest.plist of a universal IPSW describes every device it
+# supports, and we only ever want one build identity out of it. Instead of
+# decoding the whole plist, the XML is streamed through a scanner that only
+# tracks dict/array nesting to cut out each identity. Identities that
+# cannot match are dropped unparsed, and plistlib only sees the rest of the
+# manifest and the identities that may match.
+
+TAG = re.compile(rb"<(/?)(dict|array)(/?)>|<key>BuildIdentities</key>")
+# Longest TAG match, a match starting closer than this to the end of the
+# data read so far may be incomplete
+TAG_MAX = len(b"<key>BuildIdentities</key>")
+CHUNK = 256 * 1024
+
+def lookup(d, path):
+    for i in path:
+        if not isinstance(d, dict) or i not in d:
+            return None
+        d = d[i]
+    return d
+
+def matches(identity, match):
+    return all(lookup(identity, path) == want for path, want in match.items())
+
+class IdentityScanner:
+    def __init__(self, match):
+        self.match = match
+        # Every string value in match has to show up in a matching identity
+        self.needles = [b"<string>" + escape(v).encode() + b"</string>"
+                        for v in match.values() if isinstance(v, str)]
+        self.buf = bytearray()
+        self.pos = 0
+        self.depth = 0
+        # 0: before the BuildIdentities key, 1: after it, 2: in its array,
+        # 3: after the array
+        self.state = 0
+        self.head = b""
+        self.start = None
+        self.identity = None
+
+    def feed(self, data, final):
+        self.buf += data
+        buf = self.buf
+        limit = len(buf) if final else len(buf) - TAG_MAX
+        drop = 0
+        for m in TAG.finditer(buf, self.pos):
+            if m.start() >= limit:
+                break
+            self.pos = m.end()
+            if m.group(2) is None:
+                if self.depth == 1 and self.state == 0:
+                    self.state = 1
+            elif m.group(3):
+                if self.state == 1:
+                    # Empty
+                    self.state = 3
+            elif m.group(1) != b"/":
+                self.depth += 1
+                if self.state == 1 and self.depth == 2 and m.group(2) == b"array":
+                    self.head = bytes(buf[:m.end()])
+                    self.state = 2
+                    drop = m.end()
+                elif self.state == 2 and self.depth == 3:
+                    self.start = m.start()
+            else:
+                self.depth -= 1
+                if self.state == 2 and self.depth == 2 and self.start is not None:
+                    self.check(buf[self.start:m.end()])
+                    self.start = None
+                    drop = m.end()
+                elif self.state == 2 and self.depth == 1:
+                    # The rest, from </array> on, is kept for the tail
+                    self.state = 3
+                    drop = m.start()
+
+        self.pos = max(self.pos, limit)
+        if self.state == 2 and self.start is None:
+            # Between identities, there is nothing worth keeping
+            drop = self.pos
+        del buf[:drop]
+        self.pos -= drop
+        if self.start is not None:
+            self.start -= drop
+
+    def check(self, data):
+        if self.identity is not None:
+            return
+        if not all(n in data for n in self.needles):
+            return
+        identity = plistlib.loads(b"<plist>" + bytes(data) + b"</plist>")
+        if matches(identity, self.match):
+            self.identity = identity
+
+def load(fd, match):
+    # Returns the manifest with BuildIdentities reduced to the first identity
+    # that has the values in match (which maps key paths within an identity,
+    # like ("Info", "Variant"), to values), or to nothing
+    head = fd.read(8)
+    if head.startswith(b"bplist"):
+        manifest = plistlib.loads(head + fd.read())
+        manifest["BuildIdentities"] = [i for i in manifest.get("BuildIdentities", [])
+                                       if matches(i, match)][:1]
+        return manifest
+
+    scanner = IdentityScanner(match)
+    scanner.feed(head, False)
+    while True:
+        data = fd.read(CHUNK)
+        scanner.feed(data, not data)
+        if not data:
+            break
+
+    if scanner.state == 2:
+        raise plistlib.InvalidFileException("Truncated BuildIdentities")
+    manifest = plistlib.loads(scanner.head + bytes(scanner.buf))
+    if scanner.state == 3:
+        manifest["BuildIdentities"] = [] if scanner.identity is None else [scanner.identity]
+    return manifest
@@ -1207,7 +1207,10 @@ if __name__ == "__main__":
     logging.info("Startup")
 
     logging.info("Environment:")
-    for var in ("INSTALLER_BASE", "INSTALLER_DATA", "REPO_BASE", "IPSW_BASE", "EXPERT", "REPORT", "REPORT_TAG"):
+    for var in ("INSTALLER_BASE", "INSTALLER_DATA", "REPO_BASE", "IPSW_BASE", "EXPERT", "REPORT", "REPORT_TAG",
+                "URLCACHE_CONNECTIONS", "URLCACHE_BYTES", "URLCACHE_DIR",
+                "URLCACHE_MAX_CONNECTIONS", "URLCACHE_TRACE_DIR", "URLCACHE_META_DIR",
+                "ASAHI_PEER_CACHE"):
         logging.info(f"  {var}={os.environ.get(var, None)}")
 
     try:
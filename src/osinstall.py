@@ -1,5 +1,5 @@
 # SPDX-License-Identifier: MIT
-import os, shutil, sys, stat, subprocess, urlcache, zipfile, logging
+import os, shutil, sys, stat, subprocess, urlcache, zipindex, logging
 
 import m1n1
 from util import *
@@ -46,17 +46,23 @@ class OSInstaller(PackageInstaller):
         if not package:
             return
 
+        # REPO_BASE may list several mirrors, separated by spaces
+        packages = [package]
         if not package.startswith("http"):
-            package = os.environ.get("REPO_BASE", ".") + "/os/" + package
+            bases = os.environ.get("REPO_BASE", ".").split() or ["."]
+            packages = [base + "/os/" + package for base in bases]
+        if len(set(i.startswith("http") for i in packages)) > 1:
+            raise Exception(f"Cannot mix local and remote package locations: {packages}")
+        package = packages[0]
 
         logging.info(f"OS package URL: {package}")
         if package.startswith("http"):
             p_progress("Downloading OS package info...")
-            self.ucache = urlcache.URLCache(package)
-            self.pkg = zipfile.ZipFile(self.ucache)
+            self.ucache = urlcache.URLCache(packages)
+            self.pkg = self.open_package()
         else:
             p_progress("Loading OS package info...")
-            self.pkg = zipfile.ZipFile(open(package, "rb"))
+            self.pkg = zipindex.IndexedZipFile(open(package, "rb"))
         self.flush_progress()
         logging.info(f"OS package opened")
 
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+#
+# Serves the URLCache block stores in a directory to other installers on the
+# LAN. Installers started with ASAHI_PEER_CACHE=http://<host>:<port> fetch
+# from here first and go to the origin for anything this server cannot
+# provide. Blocks that are not in the store yet are fetched from the origin
+# and stored, so the first install through a peer fills it for the rest.
+#
+# Objects are those an installer run with URLCACHE_DIR=DIR has opened, or
+# those named with --add (an IPSW or OS package URL), which only records
+# them; nothing is downloaded until someone asks for it.
+#
+#   python3 peercache.py [-p PORT] [--no-fill] [--add URL]... [DIR]
+import os, re, sys, json, glob, logging, argparse, threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from urlcache import BlockStore, URLCache, store_key
+
+class PeerObject:
+    # One object in the store directory. Requests name it by its store key.
+    FILL_BLOCKS = 8
+
+    def __init__(self, path, meta, fill):
+        self.url = meta["url"]
+        self.validator = meta["validator"]
+        self.size = meta["size"]
+        self.blocksize = meta["blocksize"]
+        self.key = store_key(self.url, self.validator, self.size, self.blocksize)
+        self.etag = f'"{self.key}"'
+        self.store = BlockStore(path, self.url, self.validator, self.size, self.blocksize)
+        self.fill = fill
+        self.lock = threading.Lock()
+        self.origin = None
+
+    def get_origin(self):
+        with self.lock:
+            if self.origin is None:
+                # No block store or peer of its own, blocks go into ours
+                origin = URLCache(self.url, cache_dir="", trace_dir="", peer_cache="")
+                m = origin.mirrors[0]
+                if (origin.size != self.size or
+                    (m.etag or m.last_modified or "") != self.validator):
+                    origin.close()
+                    raise Exception(f"{self.url} has changed since it was cached")
+                self.origin = origin
+            return self.origin
+
+    def block(self, blk, last):
+        # Returns block blk, fetching it and the following missing blocks up
+        # to last (inclusive) from the origin if needed
+        if not self.store.has(blk):
+            if not self.fill:
+                raise Exception(f"Block {blk} of {self.url} is not cached")
+            end = blk + 1
+            while end <= last and end < blk + self.FILL_BLOCKS and not self.store.has(end):
+                end += 1
+            off = blk * self.blocksize
+            data = memoryview(self.get_origin().pread(off, min(end * self.blocksize, self.size) - off))
+            with self.lock:
+                for i in range(blk, end):
+                    p = (i - blk) * self.blocksize
+                    self.store.put(i, data[p:p + self.blocksize])
+            return bytes(data[:self.blocksize])
+        data = self.store.get(blk)
+        if data is None:
+            raise Exception(f"Block {blk} of {self.url} could not be read")
+        return data
+
+    def read(self, start, end):
+        # Yields the data in [start, end)
+        first = start // self.blocksize
+        last = (end - 1) // self.blocksize
+        for blk in range(first, last + 1):
+            data = self.block(blk, last)
+            boff = blk * self.blocksize
+            yield memoryview(data)[max(start, boff) - boff:min(end, boff + len(data)) - boff]
+
+    def close(self):
+        if self.origin is not None:
+            self.origin.close()
+        self.store.close()
+
+class PeerCache:
+    def __init__(self, path, fill=True):
+        self.path = path
+        self.fill = fill
+        self.lock = threading.Lock()
+        self.objects = {}
+        self.scan()
+
+    def scan(self):
+        for fn in glob.glob(os.path.join(self.path, "*.json")):
+            key = os.path.basename(fn)[:-5]
+            if key in self.objects:
+                continue
+            try:
+                with open(fn) as fd:
+                    meta = json.load(fd)
+                obj = PeerObject(self.path, meta, self.fill)
+            except Exception as e:
+                logging.warning(f"Skipping {fn}: {e}")
+                continue
+            if obj.key != key:
+                logging.warning(f"Skipping {fn}: key mismatch")
+                obj.close()
+                continue
+            logging.info(f"Serving {obj.url} as {key} "
+                         f"({obj.store.count()}/{obj.store.nblocks} blocks)")
+            self.objects[key] = obj
+
+    def get(self, key):
+        with self.lock:
+            if key not in self.objects:
+                # Stores appear as installers on this machine create them
+                self.scan()
+            return self.objects.get(key, None)
+
+def parse_ranges(spec, size):
+    # Returns a list of [start, end) ranges, None if the header is not
+    # understood (it is then ignored) or [] if nothing is satisfiable
+    if not spec.startswith("bytes="):
+        return None
+    ranges = []
+    for part in spec[6:].split(","):
+        m = re.fullmatch(r"\s*(\d*)-(\d*)\s*", part)
+        if not m or not (m.group(1) or m.group(2)):
+            return None
+        if not m.group(1):
+            n = int(m.group(2))
+            if n:
+                ranges.append((max(0, size - n), size))
+            continue
+        start = int(m.group(1))
+        end = int(m.group(2)) + 1 if m.group(2) else size
+        if end <= start and m.group(2):
+            return None
+        if start < size:
+            ranges.append((start, min(end, size)))
+    return ranges
+
+class PeerHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    BOUNDARY = "asahi-peer-cache"
+
+    def log_message(self, fmt, *args):
+        logging.info(f"{self.address_string()} {fmt % args}")
+
+    def do_HEAD(self):
+        self.handle_get(False)
+
+    def do_GET(self):
+        self.handle_get(True)
+
+    def handle_get(self, send_body):
+        obj = self.server.cache.get(self.path.lstrip("/").split("?")[0])
+        if obj is None:
+            self.send_error(404)
+            return
+
+        ranges = None
+        spec = self.headers.get("Range", None)
+        if_range = self.headers.get("If-Range", None)
+        if spec is not None and (if_range is None or if_range == obj.etag):
+            ranges = parse_ranges(spec, obj.size)
+            if ranges == []:
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{obj.size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+
+        # Fail while we can still send an error, instead of cutting the
+        # body short. HEAD only asks whether we serve the object.
+        try:
+            first = ranges[0][0] if ranges else 0
+            if obj.size and send_body:
+                obj.block(first // obj.blocksize, first // obj.blocksize)
+        except Exception as e:
+            logging.error(f"{obj.url}: {e}")
+            self.send_error(503)
+            return
+
+        parts = []
+        if ranges is None:
+            self.send_response(200)
+            self.send_header("Content-Length", str(obj.size))
+            parts.append((b"", 0, obj.size))
+        elif len(ranges) == 1:
+            start, end = ranges[0]
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{end - 1}/{obj.size}")
+            self.send_header("Content-Length", str(end - start))
+            parts.append((b"", start, end))
+        else:
+            for start, end in ranges:
+                head = (f"\r\n--{self.BOUNDARY}\r\n"
+                        f"Content-Type: application/octet-stream\r\n"
+                        f"Content-Range: bytes {start}-{end - 1}/{obj.size}\r\n\r\n").encode()
+                parts.append((head, start, end))
+            trailer = f"\r\n--{self.BOUNDARY}--\r\n".encode()
+            length = sum(len(h) + end - start for h, start, end in parts) + len(trailer)
+            self.send_response(206)
+            self.send_header("Content-Type", f"multipart/byteranges; boundary={self.BOUNDARY}")
+            self.send_header("Content-Length", str(length))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("ETag", obj.etag)
+        self.end_headers()
+        if not send_body:
+            return
+
+        try:
+            for head, start, end in parts:
+                self.wfile.write(head)
+                for data in obj.read(start, end):
+                    self.wfile.write(data)
+            if len(parts) > 1:
+                self.wfile.write(trailer)
+        except OSError:
+            # Client went away
+            self.close_connection = True
+        except Exception as e:
+            # Too late for an error status, a short body tells the client
+            # to go elsewhere
+            logging.error(f"{obj.url}: {e}")
+            self.close_connection = True
+
+class PeerServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients drop connections all the time (hedged and cancelled
+        # requests), that is not worth a traceback
+        logging.info(f"Error serving {client_address[0]}: {sys.exc_info()[1]}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve URLCache block stores to other installers")
+    parser.add_argument("-p", "--port", type=int, default=8765)
+    parser.add_argument("-b", "--bind", default="")
+    parser.add_argument("--no-fill", action="store_true",
+                        help="only serve cached blocks, never contact the origin")
+    parser.add_argument("-a", "--add", action="append", default=[], metavar="URL",
+                        help="serve this URL too")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    parser.add_argument("dir", nargs="?", default=os.environ.get("URLCACHE_DIR", None))
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(asctime)s %(levelname)s %(message)s")
+    if not args.dir:
+        parser.error("no cache directory given and URLCACHE_DIR is not set")
+
+    for url in args.add:
+        URLCache(url, cache_dir=args.dir, trace_dir="", peer_cache="").close()
+
+    server = PeerServer((args.bind, args.port), PeerHandler)
+    server.cache = PeerCache(args.dir, not args.no_fill)
+    print(f"Serving {len(server.cache.objects)} objects from {args.dir} on port {args.port}")
+    print(f"Start installers with ASAHI_PEER_CACHE=http://<this machine>:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
 # SPDX-License-Identifier: MIT
-import os, os.path, plistlib, shutil, sys, stat, subprocess, urlcache, zipfile, logging, json, tempfile
+import os, os.path, plistlib, shutil, sys, stat, subprocess, urlcache, zipindex, logging, json, tempfile
+import buildmanifest
 import osenum
 from asahi_firmware.wifi import WiFiFWCollection
 from asahi_firmware.bluetooth import BluetoothFWCollection
@@ -24,10 +25,14 @@ class StubInstaller(PackageInstaller):
     def load_ipsw(self, ipsw_info):
         self.install_version = ipsw_info.version.split(maxsplit=1)[0]
 
-        base = os.environ.get("IPSW_BASE", None)
-        url = ipsw_info.url
-        if base:
-            url = base + "/" + os.path.split(url)[-1]
+        # IPSW_BASE may list several mirrors, separated by spaces
+        bases = os.environ.get("IPSW_BASE", "").split()
+        urls = [ipsw_info.url]
+        if bases:
+            urls = [base + "/" + os.path.split(ipsw_info.url)[-1] for base in bases]
+        if len(set(i.startswith("http") for i in urls)) > 1:
+            raise Exception(f"Cannot mix local and remote IPSW locations: {urls}")
+        url = urls[0]
 
         if not url.endswith(".ipsw"):
             self.is_ota = True
@@ -39,11 +44,11 @@ class StubInstaller(PackageInstaller):
 
         if url.startswith("http"):
             p_progress("Downloading macOS OS package info...")
-            self.ucache = urlcache.URLCache(url)
-            self.pkg = zipfile.ZipFile(self.ucache)
+            self.ucache = urlcache.URLCache(urls)
+            self.pkg = self.open_package()
         else:
             p_progress("Loading macOS OS package info...")
-            self.pkg = zipfile.ZipFile(open(url, "rb"))
+            self.pkg = zipindex.IndexedZipFile(open(url, "rb"))
         self.flush_progress()
         logging.info(f"OS package opened")
         print()
@@ -215,10 +220,6 @@ class StubInstaller(PackageInstaller):
 
         logging.info("Parsing metadata...")
 
-        manifest = plistlib.load(self.open("BuildManifest.plist"))
-        self.bootcaches = plistlib.load(self.open("usr/standalone/bootcaches.plist"))
-        self.flush_progress()
-
         if self.is_ota:
             self.variant = "macOS Customer Software Update"
             self.behavior = "Update"
@@ -226,23 +227,48 @@ class StubInstaller(PackageInstaller):
             self.variant = "macOS Customer"
             self.behavior = "Erase"
 
-        self.manifest = manifest
-        for identity in manifest["BuildIdentities"]:
-            if (identity["ApBoardID"] != f'0x{self.sysinfo.board_id:02X}' or
-                identity["ApChipID"] != f'0x{self.sysinfo.chip_id:04X}' or
-                identity["Info"]["DeviceClass"] != self.sysinfo.device_class or
-                identity["Info"]["RestoreBehavior"] != self.behavior or
-                identity["Info"]["Variant"] != self.variant):
-                continue
-            break
-        else:
-            raise Exception("Failed to locate a usable build identity for this device")
+        # The identity chosen for this kind of device is cached with the
+        # package metadata, together with bootcaches
+        meta_name = (f"identity-{self.sysinfo.board_id:02X}-{self.sysinfo.chip_id:04X}-"
+                     f"{self.sysinfo.device_class}-{self.behavior}.plist")
+        cached = self.ucache.load_meta(meta_name) if self.ucache else None
+        identity = None
+        if cached is not None:
+            try:
+                meta = plistlib.loads(cached)
+                manifest = meta["Manifest"]
+                self.bootcaches = meta["Bootcaches"]
+                identity = manifest["BuildIdentities"][0]
+                logging.info("Using cached build identity")
+            except Exception as e:
+                logging.warning(f"Ignoring cached build identity: {e}")
+
+        if identity is None:
+            # Only the matching identity is decoded
+            manifest = buildmanifest.load(self.open("BuildManifest.plist"), {
+                ("ApBoardID",): f'0x{self.sysinfo.board_id:02X}',
+                ("ApChipID",): f'0x{self.sysinfo.chip_id:04X}',
+                ("Info", "DeviceClass"): self.sysinfo.device_class,
+                ("Info", "RestoreBehavior"): self.behavior,
+                ("Info", "Variant"): self.variant,
+            })
+            self.bootcaches = plistlib.load(self.open("usr/standalone/bootcaches.plist"))
+            self.flush_progress()
+
+            if not manifest["BuildIdentities"]:
+                raise Exception("Failed to locate a usable build identity for this device")
+            identity = manifest["BuildIdentities"][0]
+
+            if self.ucache:
+                self.ucache.save_meta(meta_name, plistlib.dumps({
+                    "Manifest": manifest,
+                    "Bootcaches": self.bootcaches,
+                }, fmt=plistlib.FMT_BINARY))
 
         logging.info(f'Using OS build {identity["Info"]["BuildNumber"]} for {self.sysinfo.device_class}')
 
-        self.all_identities = manifest["BuildIdentities"]
+        self.manifest = manifest
         self.identity = identity
-        manifest["BuildIdentities"] = [identity]
         return identity
 
     def install_files(self, cur_os):
@@ -266,6 +292,23 @@ class StubInstaller(PackageInstaller):
             }
         })
 
+        paths = []
+        for key, val in identity["Manifest"].items():
+            if key in ("BaseSystem", "OS", "Ap,SystemVolumeCanonicalMetadata",
+                       "RestoreRamDisk", "RestoreTrustCache"):
+                continue
+            if key.startswith("Cryptex"):
+                continue
+            paths.append(val["Info"]["Path"])
+
+        # Everything extracted below, fetched up front
+        self.prefetch(["usr/standalone/bootcaches.plist", "PlatformSupport.plist",
+                       "SystemVersion.plist", "RestoreVersion.plist",
+                       "BootabilityBundle/Restore/Firmware/Bootability.dmg.trustcache"] + paths,
+                      ["BootabilityBundle/Restore/Bootability",
+                       f"Firmware/Manifests/restore/{self.variant}/"])
+        self.flush_progress()
+
         p_progress("Setting up System volume...")
         logging.info("Setting up System volume")
 
@@ -321,13 +364,7 @@ class StubInstaller(PackageInstaller):
         self.extract_tree(f"Firmware/Manifests/restore/{self.variant}/", restore_bundle)
 
         copied = set()
-        for key, val in identity["Manifest"].items():
-            if key in ("BaseSystem", "OS", "Ap,SystemVolumeCanonicalMetadata",
-                       "RestoreRamDisk", "RestoreTrustCache"):
-                continue
-            if key.startswith("Cryptex"):
-                continue
-            path = val["Info"]["Path"]
+        for path in paths:
             if path in copied:
                 continue
             self.extract(path, restore_bundle)
@@ -421,6 +458,7 @@ class StubInstaller(PackageInstaller):
                 continue
             logging.info(f"Collecting FUD firmware for device {device}")
             device = device[:-2]
+            fud = []
             for key, val in identity["Manifest"].items():
                 if key in ("BaseSystem", "OS", "Ap,SystemVolumeCanonicalMetadata",
                            "StaticTrustCache", "SystemVolume"):
@@ -435,6 +473,10 @@ class StubInstaller(PackageInstaller):
                     or val["Info"].get("IsLoadedByiBootStage1", False)
                     or not path.endswith(".im4p")):
                     continue
+                fud.append((key, path))
+
+            self.prefetch([path for key, path in fud])
+            for key, path in fud:
                 if path not in copied:
                     self.extract(path, "fud_firmware")
                     copied.add(path)
@@ -1,208 +1,1986 @@
 # SPDX-License-Identifier: MIT
-import os, sys, os.path, time, logging, random
+import io, os, re, sys, os.path, time, logging, random, threading, hashlib, json, socket, select, ssl, errno, bisect, weakref
+from collections import OrderedDict, deque
+from itertools import zip_longest
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, Future, as_completed, wait, FIRST_COMPLETED
 from dataclasses import dataclass
 
 from urllib import parse
-from http.client import HTTPSConnection, HTTPConnection
+from http.client import HTTPSConnection, HTTPConnection, HTTPException
 from util import *
 
+class RemoteChanged(Exception):
+    pass
+
+class RangesNotSupported(Exception):
+    pass
+
+class PeerMiss(Exception):
+    pass
+
 @dataclass
-class CacheBlock:
-    idx: int
-    data: bytes
+class RetryPolicy:
+    retries: int = 10
+    base_delay: float = 0.5
+    max_delay: float = 30
+    jitter: float = 0.5
 
-class URLCache:
-    CACHESIZE = 128
-    BLOCKSIZE = 1 * 1024 * 1024
-    TIMEOUT = 30
-    MIN_READAHEAD = 8
-    MAX_READAHEAD = 64
-    SPINNER = "/-\\|"
+    def delay(self, attempt):
+        # Exponential backoff, with the last `jitter` fraction randomized so
+        # that parallel connections do not all come back at once.
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return delay * (1 - self.jitter * random.random())
 
-    def __init__(self, url):
-        self.url_str = url
-        self.url = parse.urlparse(url)
+def store_key(url, validator, size, blocksize):
+    return hashlib.sha256(f"{url}\n{validator}\n{size}\n{blocksize}".encode()).hexdigest()
+
+class BlockStore:
+    # On-disk block cache: a sparse data file the size of the remote object,
+    # plus a bitmap of the blocks that have been written to it.
+    def __init__(self, path, url, validator, size, blocksize):
+        self.size = size
+        self.blocksize = blocksize
+        self.nblocks = (size + blocksize - 1) // blocksize
+
+        os.makedirs(path, exist_ok=True)
+        base = os.path.join(path, store_key(url, validator, size, blocksize))
+
+        self.fd = os.open(base + ".data", os.O_RDWR | os.O_CREAT, 0o644)
+        if os.fstat(self.fd).st_size != size:
+            os.ftruncate(self.fd, size)
+
+        self.map_fd = os.open(base + ".map", os.O_RDWR | os.O_CREAT, 0o644)
+        mapsize = (self.nblocks + 7) // 8
+        self.bitmap = bytearray(os.pread(self.map_fd, mapsize, 0))
+        if len(self.bitmap) != mapsize:
+            self.bitmap = bytearray(mapsize)
+            os.ftruncate(self.map_fd, 0)
+            os.pwrite(self.map_fd, self.bitmap, 0)
+
+        with open(base + ".json", "w") as fd:
+            json.dump({
+                "url": url,
+                "validator": validator,
+                "size": size,
+                "blocksize": blocksize,
+            }, fd)
+
+        logging.info(f"Block store {base}: {self.count()}/{self.nblocks} blocks present")
+
+    def count(self):
+        return sum(bin(i).count("1") for i in self.bitmap)
+
+    def has(self, blk):
+        return blk < self.nblocks and bool(self.bitmap[blk >> 3] & (1 << (blk & 7)))
+
+    def get(self, blk):
+        off = blk * self.blocksize
+        size = min(self.blocksize, self.size - off)
+        data = os.pread(self.fd, size, off)
+        if len(data) != size:
+            return None
+        return data
+
+    def put(self, blk, data):
+        off = blk * self.blocksize
+        # Only complete blocks (or the tail block) are recorded
+        if len(data) != min(self.blocksize, self.size - off) or self.has(blk):
+            return
+        os.pwrite(self.fd, data, off)
+        self.bitmap[blk >> 3] |= 1 << (blk & 7)
+        os.pwrite(self.map_fd, self.bitmap[blk >> 3:(blk >> 3) + 1], blk >> 3)
+
+    def close(self):
+        os.close(self.fd)
+        os.close(self.map_fd)
+
+class AccessTrace:
+    # The ranges read from one remote object, in the order they were first
+    # read. Kept across runs as a text file of "offset size" lines, so the
+    # next run for the same object can fetch them all up front.
+    def __init__(self, path, url, validator, size, limit):
+        self.limit = limit
+        self.lock = threading.Lock()
+        self.ranges = []
+        self.seen = set()
+        self.bytes = 0
+
+        key = hashlib.sha256(f"{url}\n{validator}\n{size}".encode()).hexdigest()
+        os.makedirs(path, exist_ok=True)
+        self.path = os.path.join(path, key + ".trace")
+        self.plan = []
+        try:
+            with open(self.path) as fd:
+                for line in fd:
+                    off, length = map(int, line.split())
+                    if off >= 0 and length > 0 and off + length <= size:
+                        self.plan.append((off, length))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"Ignoring bad access trace {self.path}: {e}")
+            self.plan = []
+
+    def record(self, off, size):
+        with self.lock:
+            if self.bytes >= self.limit or (off, size) in self.seen:
+                return
+            self.seen.add((off, size))
+            self.bytes += size
+            if self.ranges and sum(self.ranges[-1]) == off:
+                self.ranges[-1] = (self.ranges[-1][0], self.ranges[-1][1] + size)
+            else:
+                self.ranges.append((off, size))
+
+    def save(self):
+        with self.lock:
+            if not self.ranges:
+                return
+            try:
+                with open(self.path + ".tmp", "w") as fd:
+                    for off, size in self.ranges:
+                        fd.write(f"{off} {size}\n")
+                os.replace(self.path + ".tmp", self.path)
+            except OSError as e:
+                logging.warning(f"Could not save access trace {self.path}: {e}")
+
+class ExtentCache:
+    # Cached byte ranges of the remote object, as non-overlapping
+    # [start, end) extents indexed by a sorted list of start offsets. New
+    # data only fills the gaps between existing extents, and is merged with
+    # adjacent extents as long as the result stays under MERGE_BYTES (larger
+    # ones would cost a big copy; reads can span neighbouring extents
+    # anyway). Extents touched by random reads (zip directory, local
+    # headers) are moved to a protected hot LRU segment, the rest live in
+    # the cold segment and are dropped once a sequential read is past them.
+    MERGE_BYTES = 256 * 1024
+
+    def __init__(self, limit, hot_limit):
+        self.limit = limit
+        self.hot_limit = hot_limit
+        self.starts = []
+        self.data = {}
+        self.cold = OrderedDict()
+        self.hot = OrderedDict()
+        self.bytes = 0
+        self.hot_bytes = 0
+
+    def end(self, start):
+        return start + len(self.data[start])
+
+    def index(self, off):
+        # Index of the extent containing off, or else of the first one after it
+        i = bisect.bisect_right(self.starts, off) - 1
+        if i >= 0 and off < self.end(self.starts[i]):
+            return i
+        return i + 1
+
+    def touch(self, start):
+        if start in self.hot:
+            self.hot.move_to_end(start)
+        else:
+            self.cold.move_to_end(start)
+
+    def prefix(self, off, end):
+        # Views of the cached bytes from off up to end or the first gap
+        parts = []
+        i = self.index(off)
+        while off < end and i < len(self.starts) and self.starts[i] <= off:
+            start = self.starts[i]
+            stop = min(end, self.end(start))
+            parts.append(self.data[start][off - start:stop - start])
+            self.touch(start)
+            off = stop
+            i += 1
+        return parts
+
+    def missing(self, off, end):
+        gaps = []
+        i = self.index(off)
+        while off < end:
+            if i < len(self.starts) and self.starts[i] <= off:
+                off = self.end(self.starts[i])
+                i += 1
+                continue
+            nxt = min(end, self.starts[i]) if i < len(self.starts) else end
+            gaps.append((off, nxt))
+            off = nxt
+        return gaps
+
+    def add(self, off, data):
+        data = memoryview(data)
+        for start, end in self.missing(off, off + len(data)):
+            self.insert(start, data[start - off:end - off])
+        self.evict()
+
+    def insert(self, off, data):
+        hot = False
+        i = bisect.bisect_left(self.starts, off)
+        if i > 0 and self.end(self.starts[i - 1]) == off:
+            prev = self.starts[i - 1]
+            if len(self.data[prev]) + len(data) <= self.MERGE_BYTES:
+                hot = prev in self.hot
+                data = memoryview(bytes(self.data[prev]) + bytes(data))
+                self.remove(prev)
+                off = prev
+                i -= 1
+        if i < len(self.starts) and self.starts[i] == off + len(data):
+            nxt = self.starts[i]
+            if len(self.data[nxt]) + len(data) <= self.MERGE_BYTES:
+                hot = hot or nxt in self.hot
+                data = memoryview(bytes(data) + bytes(self.data[nxt]))
+                self.remove(nxt)
+
+        self.starts.insert(i, off)
+        self.data[off] = data
+        self.bytes += len(data)
+        if hot:
+            self.hot[off] = None
+            self.hot_bytes += len(data)
+        else:
+            self.cold[off] = None
+
+    def remove(self, start):
+        del self.starts[bisect.bisect_left(self.starts, start)]
+        data = self.data.pop(start)
+        self.bytes -= len(data)
+        if start in self.hot:
+            del self.hot[start]
+            self.hot_bytes -= len(data)
+        else:
+            del self.cold[start]
+
+    def overlapping(self, off, end):
+        i = self.index(off)
+        j = bisect.bisect_left(self.starts, end)
+        return self.starts[i:j]
+
+    def discard(self, off, end):
+        # Drop cold extents that a sequential read starting at or before
+        # off has consumed completely
+        for start in self.overlapping(off, end):
+            if start in self.cold and self.end(start) <= end:
+                self.remove(start)
+
+    def promote(self, off, end):
+        for start in self.overlapping(off, end):
+            if start in self.hot:
+                self.hot.move_to_end(start)
+                continue
+            del self.cold[start]
+            self.hot[start] = None
+            self.hot_bytes += len(self.data[start])
+
+        while self.hot_bytes > self.hot_limit and len(self.hot) > 1:
+            start, _ = self.hot.popitem(last=False)
+            self.hot_bytes -= len(self.data[start])
+            self.cold[start] = None
+        self.evict()
+
+    def evict(self):
+        while self.bytes > self.limit:
+            if self.cold:
+                start = next(iter(self.cold))
+            else:
+                start = next(iter(self.hot))
+            self.remove(start)
+
+class Stream:
+    # A single open-ended GET (Range: bytes=N-) whose body is read into
+    # blocks by a background thread, staying at most a readahead window
+    # ahead of the consumer. The stream only holds a scheduler slot while
+    # it reads from the socket, not while it waits for the consumer, and
+    # it becomes blocking while the consumer waits for it.
+    def __init__(self, ucache, blk):
+        self.ucache = ucache
+        self.prio = ucache.priority(PREFETCH)
+        self.held = None
+        self.boost = threading.Event()
+        self.waiting = 0
+        self.start = blk
+        self.next = blk
+        self.pos = blk
+        self.window = ucache.readahead
+        self.blocks = {}
+        self.cond = threading.Condition()
+        self.error = None
+        self.closed = False
         self.con = None
-        self.size = self.get_size()
-        self.p = 0
-        self.cache = {}
-        self.blocks_read = 0
-        self.bytes_read = 0
-        self.readahead = self.MAX_READAHEAD
-        self.spin = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
 
-    def close_connection(self):
-        if self.con is not None:
+    def run(self):
+        uc = self.ucache
+        off = self.start * uc.BLOCKSIZE
+        con = None
+        m = uc.pick_mirror(uc.size - off)
+        self.take_slot()
+        try:
+            if self.closed:
+                raise Exception("Stream closed")
+            con = self.con = uc.get_con(m)
+            con.request("GET", m.path, headers=uc.range_headers(m, f"{off}-"))
+            res = con.getresponse()
+            uc.check_response(m, res, off)
+            nbytes = 0
+            busy = 0
+
+            while off < uc.size:
+                with self.cond:
+                    full = self.next - self.pos >= self.window
+                if full:
+                    self.drop_slot()
+                    with self.cond:
+                        while self.next - self.pos >= self.window and not self.closed:
+                            self.cond.wait()
+                    if not self.closed:
+                        self.take_slot()
+                if self.closed:
+                    break
+                size = min(uc.BLOCKSIZE, uc.size - off)
+                buf = memoryview(bytearray(size))
+                got = 0
+                t0 = time.time()
+                while got < size:
+                    n = res.readinto(buf[got:])
+                    if not n:
+                        raise Exception(f"Stream ended early at {off + got}")
+                    got += n
+                # The consumer may have kept us waiting, so only count the
+                # time spent reading
+                busy += time.time() - t0
+                nbytes += size
+                with uc.stats_lock:
+                    uc.bytes_fetched += size
+                if uc.too_slow(m, nbytes, busy):
+                    raise Exception("Mirror is too slow")
+                with self.cond:
+                    # The reader may have skipped ahead over cached blocks
+                    if self.next >= self.pos:
+                        self.blocks[self.next] = buf
+                    self.next += 1
+                    self.cond.notify_all()
+                off += size
+        except Exception as e:
+            if m.peer and not self.closed:
+                # Ran into a part the peer does not have
+                logging.info(f"Streaming request for {m.url_str} stopped at {off}: {e}")
+            elif not self.closed:
+                logging.warning(f"Streaming request for {m.url_str} failed at {off}: {e}")
+            with self.cond:
+                self.error = e
+                self.con = None
+                self.cond.notify_all()
+            if con is not None:
+                uc.drop_con(con)
+            self.drop_slot()
+            return
+
+        with self.cond:
+            self.con = None
+            closed = self.closed
+        if closed:
+            uc.drop_con(con)
+        else:
+            uc.put_con(con)
+        self.drop_slot()
+
+    def take_slot(self):
+        with self.cond:
+            # A consumer is waiting already
+            if self.waiting:
+                self.boost.set()
+        self.held = scheduler.acquire(self.prio, self.boost)
+        with self.cond:
+            self.boost = threading.Event()
+
+    def drop_slot(self):
+        if self.held is not None:
+            scheduler.release(self.held)
+            self.held = None
+
+    def get(self, blk, window):
+        with self.cond:
+            if blk < self.start or (blk < self.pos and blk not in self.blocks):
+                # Already handed out or dropped
+                return None
+            self.window = window
+            if blk > self.pos:
+                for i in range(self.pos, blk):
+                    self.blocks.pop(i, None)
+                self.pos = blk
+                self.cond.notify_all()
+            # Somebody is blocked on us now. If the stream stops making
+            # progress (no slot, stalled server), give up on it and let the
+            # caller use ranged requests.
+            self.waiting += 1
+            if blk not in self.blocks:
+                scheduler.boost(self.boost)
+            deadline = time.time() + self.ucache.STREAM_STALL
+            seen = self.next
+            while blk not in self.blocks and self.error is None and not self.closed:
+                if self.next != seen:
+                    seen = self.next
+                    deadline = time.time() + self.ucache.STREAM_STALL
+                left = deadline - time.time()
+                if left <= 0:
+                    logging.info(f"Stream for {self.ucache.url_str} stalled at block {self.next}")
+                    break
+                self.cond.wait(left)
+            self.waiting -= 1
+            data = self.blocks.pop(blk, None)
+            if data is not None:
+                self.pos = blk + 1
+                self.cond.notify_all()
+            return data
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+            con = self.con
+        # Unblock the reader thread if it is waiting on the socket
+        if con is not None and con.sock is not None:
             try:
-                self.con.close()
-            except Exception:
+                con.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
                 pass
+
+class Transfer:
+    # Lets another thread abort a get_partial() call by shutting down its
+    # connection. The connection is only reachable while the request runs,
+    # once it goes back to the pool it belongs to someone else.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.con = None
+        self.cancelled = False
+        # Set once the request is about to go out, i.e. it has a scheduler
+        # slot and a connection
+        self.sent = threading.Event()
+        self.sent_time = None
+
+    def attach(self, con):
+        with self.lock:
+            if self.cancelled:
+                raise Exception("Transfer cancelled")
+            self.con = con
+            if self.sent_time is None:
+                self.sent_time = time.time()
+            self.sent.set()
+
+    def detach(self):
+        with self.lock:
             self.con = None
 
-    def get_con(self):
-        if self.con is not None:
-            return self.con
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            if self.con is not None and self.con.sock is not None:
+                try:
+                    self.con.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+class Cursor:
+    # Per-reader state: the position, and what is needed to detect and
+    # serve sequential reads
+    def __init__(self, p=0):
+        self.p = p
+        self.last_end = None
+        self.seq_bytes = 0
+        self.stream = None
+        self.stream_after = 0
+
+class PooledHTTPSConnection(HTTPSConnection):
+    # HTTPSConnection that offers a previous TLS session for resumption
+    def __init__(self, *args, tls_session=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.tls_session = tls_session
+
+    def connect(self):
+        HTTPConnection.connect(self)
+        server_hostname = self._tunnel_host or self.host
+        self.sock = self._context.wrap_socket(self.sock, server_hostname=server_hostname,
+                                              session=self.tls_session)
+
+class ConnectionPool:
+    # Process-wide keep-alive pool, shared by all URLCache instances. Idle
+    # connections are kept per (scheme, host, port), and the last TLS
+    # session per host is remembered so new connections can resume it.
+    IDLE_TIMEOUT = 20
+    MAX_IDLE = 8
+    # RFC 8305 "Connection Attempt Delay"
+    ATTEMPT_DELAY = 0.25
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.sessions = {}
+        self.context = None
+        self.connects = 0
+        self.resumed = 0
+        # (host, port) -> getaddrinfo() results, and the address that last
+        # won the connection race
+        self.dns = {}
+        self.preferred = {}
+
+    def key(self, url):
+        return (url.scheme, url.netloc)
+
+    def usable(self, con, last_used):
+        if time.time() - last_used > self.IDLE_TIMEOUT:
+            return False
+        if con.sock is None:
+            return False
+        # An idle connection should have nothing to read; if it does, the
+        # server has closed it (or sent garbage)
+        try:
+            readable, _, _ = select.select([con.sock], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    def get(self, url, timeout):
+        key = self.key(url)
+        while True:
+            with self.lock:
+                idle = self.idle.get(key, [])
+                if not idle:
+                    break
+                con, last_used = idle.pop()
+            if self.usable(con, last_used):
+                return con
+            self.drop(con)
 
-        if ":" in self.url.netloc:
-            host, port = self.url.netloc.split(":")
+        return self.connect(url, key, timeout)
+
+    def connect(self, url, key, timeout):
+        if ":" in url.netloc:
+            host, port = url.netloc.split(":")
             port = int(port)
         else:
-            host, port = self.url.netloc, None
+            host, port = url.netloc, None
 
-        if self.url.scheme == "http":
+        if url.scheme == "http":
             http_proxy = os.getenv('HTTP_PROXY') or os.getenv('http_proxy')
             if http_proxy:
                 proxy_url = parse.urlparse(http_proxy)
                 if proxy_url.scheme != "http":
                     raise Exception(f"Unsupported scheme '{proxy_url.scheme}' for http proxy; only http proxy is supported.")
-                self.con = HTTPConnection(proxy_url.hostname, proxy_url.port or 80, timeout=self.TIMEOUT)
-                self.con.set_tunnel(host, port)
+                con = HTTPConnection(proxy_url.hostname, proxy_url.port or 80, timeout=timeout)
+                con.set_tunnel(host, port)
             else:
-                self.con = HTTPConnection(host, port, timeout=self.TIMEOUT)
-        elif self.url.scheme == "https":
+                con = HTTPConnection(host, port, timeout=timeout)
+        elif url.scheme == "https":
+            with self.lock:
+                if self.context is None:
+                    self.context = ssl.create_default_context()
+                session = self.sessions.get(key, None)
             https_proxy = os.getenv('HTTPS_PROXY') or os.getenv('https_proxy')
             if https_proxy:
                 proxy_url = parse.urlparse(https_proxy)
                 if proxy_url.scheme != "http":
                     raise Exception(f"Unsupported scheme '{proxy_url.scheme}' for https proxy; only http proxy is supported.")
-                self.con = HTTPSConnection(proxy_url.hostname, proxy_url.port or 80, timeout=self.TIMEOUT)
-                self.con.set_tunnel(host, port)
+                con = PooledHTTPSConnection(proxy_url.hostname, proxy_url.port or 80, timeout=timeout,
+                                            context=self.context, tls_session=session)
+                con.set_tunnel(host, port)
             else:
-                self.con = HTTPSConnection(host, port, timeout=self.TIMEOUT)
+                con = PooledHTTPSConnection(host, port, timeout=timeout,
+                                            context=self.context, tls_session=session)
         else:
-            raise Exception(f"Unsupported scheme {self.url.scheme}")
+            raise Exception(f"Unsupported scheme {url.scheme}")
+
+        con.pool_key = key
+        con._create_connection = self.create_connection
+        with self.lock:
+            self.connects += 1
+        return con
+
+    def addresses(self, host, port):
+        with self.lock:
+            addrs = self.dns.get((host, port), None)
+        if addrs is None:
+            addrs = socket.getaddrinfo(host, port, type=socket.SOCK_STREAM)
+            with self.lock:
+                self.dns[(host, port)] = addrs
+
+        # Alternate address families, starting with the one the resolver
+        # preferred, and put the last winner first.
+        first = [a for a in addrs if a[0] == addrs[0][0]]
+        rest = [a for a in addrs if a[0] != addrs[0][0]]
+        order = [a for pair in zip_longest(first, rest) for a in pair if a is not None]
+        with self.lock:
+            preferred = self.preferred.get((host, port), None)
+        order.sort(key=lambda a: a[4] != preferred)
+        return order
+
+    def create_connection(self, address, timeout=None, source_address=None):
+        # Happy Eyeballs (RFC 8305): start connecting to the next address
+        # whenever the previous attempts have not succeeded within
+        # ATTEMPT_DELAY (or have failed), and keep the first one to connect.
+        host, port = address
+        addrs = self.addresses(host, port)
+        deadline = time.time() + (timeout or 60)
+        pending = {}
+        errors = []
+        winner = None
+        next_start = 0
+        i = 0
+        try:
+            while winner is None:
+                now = time.time()
+                if i < len(addrs) and (now >= next_start or not pending):
+                    family, type, proto, _, sa = addrs[i]
+                    i += 1
+                    sock = socket.socket(family, type, proto)
+                    try:
+                        sock.setblocking(False)
+                        if source_address:
+                            sock.bind(source_address)
+                        err = sock.connect_ex(sa)
+                        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+                            raise OSError(err, os.strerror(err))
+                    except OSError as e:
+                        sock.close()
+                        errors.append(e)
+                        continue
+                    pending[sock] = sa
+                    next_start = now + self.ATTEMPT_DELAY
+                    continue
+
+                if not pending or now >= deadline:
+                    break
+                until = deadline if i >= len(addrs) else min(deadline, next_start)
+                _, ready, _ = select.select([], list(pending), [], max(0, until - now))
+                for sock in ready:
+                    sa = pending.pop(sock)
+                    err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                    if err == 0 and winner is None:
+                        winner = sock, sa
+                        continue
+                    sock.close()
+                    if err:
+                        errors.append(OSError(err, f"{os.strerror(err)} ({sa[0]})"))
+                        next_start = 0
+        finally:
+            for sock in pending:
+                sock.close()
+
+        if winner is None:
+            if errors:
+                raise errors[-1]
+            raise socket.timeout(f"Timed out connecting to {host}")
+
+        sock, sa = winner
+        sock.settimeout(timeout)
+        with self.lock:
+            self.preferred[(host, port)] = sa
+        if errors:
+            logging.info(f"Connected to {host} via {sa[0]} after {len(errors)} failed attempts")
+        return sock
+
+    def put(self, con):
+        key = getattr(con, "pool_key", None)
+        if key is None or con.sock is None:
+            self.drop(con)
+            return
+
+        with self.lock:
+            if isinstance(con.sock, ssl.SSLSocket):
+                # With TLS 1.3 the session ticket only shows up after some
+                # data has been read, so pick it up here rather than on connect
+                session = con.sock.session
+                if session is not None:
+                    self.sessions[key] = session
+                if getattr(con, "counted", False) is False:
+                    con.counted = True
+                    if con.sock.session_reused:
+                        self.resumed += 1
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.MAX_IDLE:
+                idle.append((con, time.time()))
+                return
+
+        self.drop(con)
+
+    def drop(self, con):
+        try:
+            con.close()
+        except Exception:
+            pass
+
+    def close_idle(self, url):
+        with self.lock:
+            idle = self.idle.pop(self.key(url), [])
+            for key in [k for k in self.dns if k[0] == url.hostname]:
+                del self.dns[key]
+        for con, last_used in idle:
+            self.drop(con)
+
+# Request priorities for the scheduler
+BLOCKING, PREFETCH, BACKGROUND = range(3)
 
-        return self.con
+class Scheduler:
+    # Process-wide admission control: every HTTP request from any URLCache
+    # needs a slot, and there are at most `limit` slots. Waiting blocking
+    # requests always go first. Prefetch and background requests share
+    # what is left by weight, and together never take the last RESERVED
+    # slots, so a blocking read never waits behind a full pipe of
+    # speculative ones.
+    LIMIT = 8
+    RESERVED = 1
+    WEIGHTS = {PREFETCH: 4, BACKGROUND: 1}
+
+    def __init__(self, limit=None):
+        if limit is None:
+            limit = int(os.environ.get("URLCACHE_MAX_CONNECTIONS", self.LIMIT))
+        self.limit = max(1, limit)
+        self.cond = threading.Condition()
+        self.active = [0] * 3
+        self.waiting = [deque() for i in range(3)]
+        # Start-time fair queueing between the weighted classes
+        self.vtime = 0
+        self.vfinish = {prio: 0 for prio in self.WEIGHTS}
+        self.served = [0] * 3
+        self.waited = [0] * 3
+
+    def next_ticket(self):
+        if sum(self.active) >= self.limit:
+            return None
+        if self.waiting[BLOCKING]:
+            return self.waiting[BLOCKING][0]
+        # With a single slot there is nothing to reserve, blocking requests
+        # still go first whenever it frees up
+        reserved = min(self.RESERVED, self.limit - 1)
+        if sum(self.active) - self.active[BLOCKING] >= self.limit - reserved:
+            return None
+        ready = [prio for prio in self.WEIGHTS if self.waiting[prio]]
+        if not ready:
+            return None
+        prio = min(ready, key=lambda prio: self.vfinish[prio])
+        return self.waiting[prio][0]
+
+    def acquire(self, prio, boost=None):
+        # Returns the class the slot was granted in, which is BLOCKING if
+        # the boost event (see boost()) was set while we were waiting
+        ticket = object()
+        t0 = time.time()
+        with self.cond:
+            if prio in self.WEIGHTS and not self.waiting[prio]:
+                # An idle class does not get to bank its unused share
+                self.vfinish[prio] = max(self.vfinish[prio], self.vtime)
+            self.waiting[prio].append(ticket)
+            while self.next_ticket() is not ticket:
+                if boost is not None and boost.is_set() and prio != BLOCKING:
+                    self.waiting[prio].remove(ticket)
+                    prio = BLOCKING
+                    self.waiting[prio].append(ticket)
+                    continue
+                self.cond.wait()
+            self.waiting[prio].popleft()
+            self.active[prio] += 1
+            self.served[prio] += 1
+            self.waited[prio] += time.time() - t0
+            if prio in self.WEIGHTS:
+                self.vtime = self.vfinish[prio]
+                self.vfinish[prio] += 1 / self.WEIGHTS[prio]
+            self.cond.notify_all()
+        return prio
+
+    def boost(self, event):
+        # A blocking reader needs what a queued speculative request is
+        # going to fetch: move it up to BLOCKING
+        with self.cond:
+            event.set()
+            self.cond.notify_all()
+
+    def release(self, prio):
+        with self.cond:
+            self.active[prio] -= 1
+            self.cond.notify_all()
+
+    @contextmanager
+    def slot(self, prio, boost=None):
+        prio = self.acquire(prio, boost)
+        try:
+            yield
+        finally:
+            self.release(prio)
+
+connection_pool = ConnectionPool()
+scheduler = Scheduler()
+# Origin URL -> final URL after redirects, shared by all instances
+redirect_cache = {}
+
+class Mirror:
+    # One of several locations serving the same object. Validators and
+    # performance are tracked per mirror, since CDNs do not agree on ETags.
+    def __init__(self, url):
+        self.url_str = url
+        self.url = parse.urlparse(url)
+        self.etag = None
+        self.last_modified = None
+        self.size = None
+        self.rtt = None
+        self.bw = None
+        self.failures = 0
+        self.peer = False
+
+    @property
+    def path(self):
+        if self.url.query:
+            return f"{self.url.path}?{self.url.query}"
+        return self.url.path
+
+    def cost(self, nbytes):
+        # Expected time to fetch nbytes. Mirrors without a bandwidth
+        # estimate yet look cheap, so they get tried.
+        if self.bw is None:
+            return self.rtt or 0
+        return self.rtt + nbytes / self.bw
+
+class URLCache(io.RawIOBase):
+    CACHE_BYTES = 256 * 1024 * 1024
+    HOT_BYTES = 32 * 1024 * 1024
+    BLOCKSIZE = 1 * 1024 * 1024
+    TIMEOUT = 30
+    MIN_READAHEAD = 8
+    MAX_READAHEAD = 64
+    # Aim for requests long enough that the request latency is a small
+    # fraction of the transfer time: this many bandwidth-delay products.
+    BDP_FACTOR = 8
+    EWMA_ALPHA = 0.3
+    # Reads that are not part of a sequential run (zip EOCD, local headers,
+    # members) fetch just what they miss, rounded out to SMALL_ALIGN. Deep
+    # readahead only starts once SEQ_THRESHOLD bytes have been consumed
+    # sequentially, and is rounded out to BLOCKSIZE, the unit of the
+    # on-disk store.
+    SMALL_ALIGN = 16 * 1024
+    SEQ_THRESHOLD = 1024 * 1024
+    # prefetch() merges ranges closer than this, and sends at most MAX_RANGES
+    # ranges per multi-range request.
+    COALESCE_GAP = 64 * 1024
+    MAX_RANGES = 64
+    # Switch to a single streaming GET once this much has been read
+    # sequentially, instead of issuing one ranged request per window.
+    STREAM_THRESHOLD = 64 * 1024 * 1024
+    # A reader waiting this long for a stream that makes no progress goes
+    # back to ranged requests
+    STREAM_STALL = 30
+    # The object size comes from the first ranged GET, which fetches this
+    # much of the tail (enough for the zip EOCD and a maximum size comment).
+    PROBE_SIZE = 64 * 1024 + 22
+    MAX_REDIRECTS = 10
+    # With several mirrors, requests go to the one expected to be fastest,
+    # except for an EXPLORE fraction that keeps the others' estimates fresh.
+    # A transfer running at less than SLOW_FRACTION of the best alternative
+    # after SLOW_CHECK seconds is cut short and the rest moves elsewhere.
+    EXPLORE = 0.05
+    SLOW_FRACTION = 0.25
+    SLOW_CHECK = 2
+    CHUNK = 256 * 1024
+    # A ranged request taking longer than the HEDGE_PERCENTILE latency of
+    # recent ones (scaled to its size) gets a duplicate on another
+    # connection, and the first to complete wins. Duplicates may use at
+    # most HEDGE_BUDGET of the bytes fetched so far.
+    HEDGE_PERCENTILE = 0.95
+    HEDGE_SAMPLES = 20
+    HEDGE_MIN = 0.25
+    HEDGE_BUDGET = 0.05
+    CONNECTIONS = 4
+    MIN_SPLIT = 4
+    # Random reads are recorded up to TRACE_BYTES, and prefetched on the
+    # next run for the same object
+    TRACE_BYTES = 64 * 1024 * 1024
+    SPINNER = "/-\\|"
+
+    def __init__(self, url, connections=None, cache_bytes=None, cache_dir=None,
+                 retry=None, priority=BLOCKING, trace_dir=None, peer_cache=None,
+                 meta_dir=None):
+        # url may also be a list of equivalent mirrors. priority is the most
+        # urgent class any of our requests may use; BACKGROUND makes the
+        # whole instance yield to everything else.
+        super().__init__()
+        self.base_priority = priority
+        self.retry = retry or RetryPolicy()
+        if isinstance(url, str):
+            url = [url]
+        self.mirrors = [Mirror(i) for i in url]
+        if not self.mirrors:
+            raise Exception("No URLs given")
+        self.url_str = self.mirrors[0].url_str
+        if connections is None:
+            connections = int(os.environ.get("URLCACHE_CONNECTIONS", self.CONNECTIONS))
+        self.connections = max(1, connections)
+        self.executor = None
+        self.store = None
+        self.trace = None
+        self.meta_dir = None
+        # Guards the cache, the store and the in-flight table. Never held
+        # while waiting for the network.
+        self.lock = threading.RLock()
+        self.inflight = {}
+        self.cursor = Cursor()
+        self.readers = weakref.WeakSet()
+        if cache_bytes is None:
+            cache_bytes = int(os.environ.get("URLCACHE_BYTES", self.CACHE_BYTES))
+        self.cache = ExtentCache(max(cache_bytes, 2 * self.MAX_READAHEAD * self.BLOCKSIZE),
+                                 self.HOT_BYTES)
+        self.hits = 0
+        self.misses = 0
+        self.hit_bytes = 0
+        self.miss_bytes = 0
+        self.blocks_read = 0
+        self.bytes_read = 0
+        self.readahead = self.MIN_READAHEAD
+        self.stats_lock = threading.Lock()
+        self.rtt = None
+        self.bw = None
+        self.latencies = deque(maxlen=100)
+        self.bytes_fetched = 0
+        self.hedge_pool = None
+        self.readahead_pool = None
+        self.hedge_bytes = 0
+        self.hedged = 0
+        self.hedges_won = 0
+        self.spin = 0
+
+        tail = self.resolve_mirrors()
+
+        if cache_dir is None:
+            cache_dir = os.environ.get("URLCACHE_DIR", None)
+        if trace_dir is None:
+            trace_dir = os.environ.get("URLCACHE_TRACE_DIR", cache_dir)
+        # Leave out the query, CDN redirects often carry expiring tokens
+        m = self.mirrors[0]
+        key_url = parse.urlunparse(m.url._replace(query=""))
+        validator = m.etag or m.last_modified or ""
+        self.key = store_key(key_url, validator, self.size, self.BLOCKSIZE)
+        if cache_dir:
+            self.store = BlockStore(cache_dir, key_url, validator, self.size, self.BLOCKSIZE)
+        if trace_dir and validator:
+            # Without a validator a trace could describe some other version
+            self.trace = AccessTrace(trace_dir, key_url, validator, self.size, self.TRACE_BYTES)
+        # Metadata our users derive from an object (zip index, manifest) is
+        # kept across runs only when asked for, like the blocks themselves
+        if meta_dir is None:
+            meta_dir = os.environ.get("URLCACHE_META_DIR", cache_dir)
+        if meta_dir and validator:
+            self.meta_dir = meta_dir
+
+        if peer_cache is None:
+            peer_cache = os.environ.get("ASAHI_PEER_CACHE", None)
+        if peer_cache and validator:
+            self.add_peer(peer_cache)
+
+        if tail:
+            self.add_span(self.size - len(tail), memoryview(tail))
+
+        if self.trace is not None and self.trace.plan:
+            threading.Thread(target=self.replay_trace, daemon=True).start()
+
+    def load_meta(self, name):
+        # Returns what save_meta() stored under name for this very object
+        # (same URL, validator and size), or None
+        if self.meta_dir is None:
+            return None
+        try:
+            with open(os.path.join(self.meta_dir, f"{self.key}.{name}"), "rb") as fd:
+                return fd.read()
+        except OSError:
+            return None
+
+    def save_meta(self, name, data):
+        if self.meta_dir is None:
+            return
+        path = os.path.join(self.meta_dir, f"{self.key}.{name}")
+        try:
+            os.makedirs(self.meta_dir, exist_ok=True)
+            with open(path + ".tmp", "wb") as fd:
+                fd.write(data)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            logging.warning(f"Could not save {path}: {e}")
+
+    def close_connection(self):
+        # Connections are shared, this only drops the idle ones to our hosts.
+        # TLS sessions are kept, so reconnecting stays cheap.
+        for m in self.mirrors:
+            connection_pool.close_idle(m.url)
+        self.log_stats()
+
+    def log_stats(self):
+        if self.hedged:
+            logging.info(f"Hedged {self.hedged} requests for {self.url_str}, "
+                         f"{self.hedges_won} hedges won")
+        logging.info(f"Cache for {self.url_str}: {self.hits} hits ({self.hit_bytes} bytes), "
+                     f"{self.misses} misses ({self.miss_bytes} bytes), "
+                     f"{self.bytes_fetched} bytes fetched")
+        logging.info(f"Connection pool: {connection_pool.connects} connections opened, "
+                     f"{connection_pool.resumed} TLS sessions resumed")
+        logging.info("Scheduler: " + ", ".join(
+            f"{name} {scheduler.served[prio]} requests (waited {scheduler.waited[prio]:.2f}s)"
+            for prio, name in ((BLOCKING, "blocking"), (PREFETCH, "prefetch"),
+                               (BACKGROUND, "background"))))
+
+    def drop_con(self, con):
+        connection_pool.drop(con)
+
+    def put_con(self, con):
+        connection_pool.put(con)
+
+    def get_con(self, m):
+        return connection_pool.get(m.url, self.TIMEOUT)
 
     def seekable(self):
         return True
 
-    def get_size(self):
-        for i in range(10):
-            con = self.get_con()
-            con.request("HEAD", self.url.path, headers={"Connection":" keep-alive"})
-            res = con.getresponse()
-            res.read()
-            loc = res.getheader("Location", None)
-            if loc is not None:
-                self.url = parse.urlparse(loc)
-                self.con = None
-                continue
-            return int(res.getheader("Content-length"))
+    def get_executor(self, prio=BLOCKING):
+        # Speculative work has its own threads, so that blocking fetches
+        # never queue behind it
+        with self.lock:
+            if prio != BLOCKING:
+                if self.readahead_pool is None:
+                    self.readahead_pool = ThreadPoolExecutor(max_workers=self.connections)
+                return self.readahead_pool
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.connections)
+            return self.executor
 
-        raise Exception("Maximum number of redirects reached")
+    def priority(self, prio):
+        return max(prio, self.base_priority)
 
-    def get_partial(self, off, size, bypass_cache=False):
-        path = self.url.path
-        if bypass_cache:
-            path += f"?{random.random()}"
+    def resolve_mirrors(self):
+        # Probe all mirrors at once. The first one to answer defines the
+        # object, the others must agree on its size and tail bytes or they
+        # are left out. Returns the tail data.
+        if len(self.mirrors) == 1:
+            tail = self.resolve(self.mirrors[0])
+            self.size = self.mirrors[0].size
+            return tail
+
+        ref = None
+        tails = {}
+        errors = []
+        good = []
+        with ThreadPoolExecutor(max_workers=len(self.mirrors)) as pool:
+            futures = {pool.submit(self.resolve, m): m for m in self.mirrors}
+            for f in as_completed(futures):
+                m = futures[f]
+                try:
+                    tail = f.result()
+                except Exception as e:
+                    p_warning(f"Mirror {m.url_str} is not usable: {e}")
+                    errors.append(e)
+                    continue
+                if ref is None:
+                    ref = m
+                    tails[m] = tail
+                elif m.size != ref.size:
+                    p_warning(f"Mirror {m.url_str} has a different size "
+                              f"({m.size} vs. {ref.size}), not using it")
+                    continue
+                elif tail and tails[ref] and bytes(tail) != bytes(tails[ref]):
+                    p_warning(f"Mirror {m.url_str} has different contents, not using it")
+                    continue
+                elif m.etag != ref.etag:
+                    # Normal across different servers, each mirror's ranges
+                    # are pinned to its own ETag
+                    logging.info(f"Mirror {m.url_str} ETag {m.etag} differs from "
+                                 f"{ref.url_str} ETag {ref.etag}")
+                tails[m] = tail
+                good.append(m)
+
+        if ref is None:
+            raise errors[0]
+
+        # Keep the configured order, the first mirror names the block store
+        self.mirrors = [m for m in self.mirrors if m is ref or m in good]
+        self.size = ref.size
+        for m in self.mirrors:
+            logging.info(f"Mirror {m.url_str}: rtt={m.rtt}")
+        return tails[ref]
 
-        res = None
+    def add_peer(self, base):
+        # A LAN cache (peercache.py) serving a block store of this object.
+        # Its object is named by the store key, which covers the origin's
+        # URL, validator and size, and it must report the same key as its
+        # ETag. It need not have any data yet. It is then preferred over
+        # the other mirrors.
+        m = Mirror(f"{base.rstrip('/')}/{self.key}")
+        m.peer = True
         try:
-            con = self.get_con()
-            con.request("GET", path, headers={
-                "Connection": "keep-alive",
-                "Range": f"bytes={off}-{off+size-1}",
-            })
-            res = con.getresponse()
-            d = res.read()
+            with scheduler.slot(self.priority(BLOCKING)):
+                con = self.get_con(m)
+                try:
+                    con.request("HEAD", m.path, headers={"Connection": "keep-alive"})
+                    res = con.getresponse()
+                    res.read()
+                except Exception:
+                    self.drop_con(con)
+                    raise
+                self.put_con(con)
+            m.etag = res.getheader("ETag", None)
+            m.size = int(res.getheader("Content-Length", -1))
         except Exception as e:
-            logging.error(f"Request failed for {self.url_str} range {off}-{off+size-1}")
-            if res is not None:
-                logging.error(f"Response headers: {res.headers.as_string()}")
-            raise
+            p_warning(f"Peer cache {base} is not usable: {e}")
+            return
+        if res.status != 200 or m.etag != f'"{self.key}"' or m.size != self.size:
+            p_warning(f"Peer cache {base} does not match {self.url_str}, not using it")
+            return
+        logging.info(f"Using peer cache {m.url_str} for {self.url_str}")
+        self.mirrors.append(m)
 
-        if not d:
-            raise Exception(f"Server returned no data for for {self.url_str} range {off}-{off+size-1}")
+    def pick_mirror(self, nbytes=None, peers=True):
+        mirrors = self.mirrors if peers else [m for m in self.mirrors if not m.peer]
+        if len(mirrors) == 1:
+            return mirrors[0]
+        if nbytes is None:
+            nbytes = self.BLOCKSIZE
+        with self.stats_lock:
+            ranked = sorted(mirrors, key=lambda m: (m.failures, not m.peer, m.cost(nbytes)))
+        # A healthy peer gets everything, exploring would only send traffic
+        # to the internet (and a stream picks its mirror for good)
+        if not ranked[0].peer and random.random() < self.EXPLORE:
+            return random.choice(ranked[1:])
+        return ranked[0]
 
-        self.spin = (self.spin + 1) % len(self.SPINNER)
-        sys.stdout.write(f"\r{self.SPINNER[self.spin]} ")
-        sys.stdout.flush()
-        self.blocks_read += 1
-        self.bytes_read += len(d)
+    def too_slow(self, m, nbytes, elapsed):
+        # Whether a transfer from m running at this rate should rather be
+        # moved to another mirror
+        if len(self.mirrors) == 1 or elapsed < self.SLOW_CHECK:
+            return False
+        rate = nbytes / elapsed
+        with self.stats_lock:
+            best = max((o.bw for o in self.mirrors if o is not m and o.bw and not o.failures),
+                       default=None)
+            if best is None or rate >= best * self.SLOW_FRACTION:
+                return False
+            m.bw = self.ewma(m.bw, rate)
+        logging.info(f"Mirror {m.url_str} is slow ({rate / 1024 / 1024:.2f} MiB/s vs. "
+                     f"{best / 1024 / 1024:.2f} MiB/s), moving elsewhere")
+        return True
 
-        return d
+    def resolve(self, m):
+        # Instead of a HEAD request, ask for the tail of the object: the size
+        # comes from Content-Range and the data is what zipfile reads first
+        # anyway. Returns that data.
+        target = redirect_cache.get(m.url_str, None)
+        if target is not None:
+            m.url = parse.urlparse(target)
+            try:
+                return self.probe(m)
+            except Exception as e:
+                logging.info(f"Cached redirect {target} failed ({e}), starting over")
+                redirect_cache.pop(m.url_str, None)
+                m.url = parse.urlparse(m.url_str)
+
+        policy = self.retry
+        for failures in range(policy.retries + 1):
+            try:
+                tail = self.probe(m)
+                break
+            except (OSError, HTTPException) as e:
+                # Connection trouble only, HTTP errors are final
+                if failures == policy.retries:
+                    raise
+                p_warning(f"Error opening {m.url_str} ({e}), retrying... "
+                          f"({failures + 1}/{policy.retries})")
+                time.sleep(policy.delay(failures))
+                m.url = parse.urlparse(m.url_str)
+        if m.url_str != parse.urlunparse(m.url):
+            redirect_cache[m.url_str] = parse.urlunparse(m.url)
+        return tail
 
-    def get_block(self, blk, readahead=1):
-        if blk in self.cache:
-            return self.cache[blk]
+    def probe(self, m):
+        with scheduler.slot(self.priority(BLOCKING)):
+            for i in range(self.MAX_REDIRECTS):
+                res = None
+                con = self.get_con(m)
+                try:
+                    t0 = time.time()
+                    con.request("GET", m.path, headers={
+                        "Connection": "keep-alive",
+                        "Range": f"bytes=-{self.PROBE_SIZE}",
+                    })
+                    res = con.getresponse()
+                    t1 = time.time()
+                    loc = res.getheader("Location", None)
+                    if loc is not None or res.status == 416:
+                        res.read()
+                        data = None
+                    elif res.status == 206:
+                        data = res.read()
+                    elif res.status == 200 and (res.length or 0) <= self.PROBE_SIZE:
+                        data = res.read()
+                    elif res.status == 200:
+                        # Server does not do ranges, just take the size
+                        data = None
+                    else:
+                        raise Exception(f"HTTP error {res.status} {res.reason}")
+                except Exception:
+                    self.drop_con(con)
+                    logging.error(f"Request failed for {m.url_str}")
+                    if res is not None:
+                        logging.error(f"Response headers: {res.headers.as_string()}")
+                    raise
 
-        off = blk * self.BLOCKSIZE
-        size = self.BLOCKSIZE
+                if res.isclosed():
+                    self.put_con(con)
+                else:
+                    self.drop_con(con)
 
-        blocks = max(self.MIN_READAHEAD,
-                     min(readahead, self.readahead)) - 1
+                if loc is not None:
+                    m.url = parse.urlparse(parse.urljoin(parse.urlunparse(m.url), loc))
+                    continue
 
-        for i in range(blocks):
-            if blk + i in self.cache:
-                break
-            size += self.BLOCKSIZE
+                m.etag = res.getheader("ETag", None)
+                m.last_modified = res.getheader("Last-Modified", None)
+
+                if res.status == 200:
+                    m.size = res.length if data is None else len(data)
+                    if m.size is None:
+                        raise Exception(f"Could not determine the size of {m.url_str}")
+                    return data
+
+                mt = re.match(r"bytes (?:\d+-\d+|\*)/(\d+)", res.getheader("Content-Range", ""))
+                if not mt:
+                    raise Exception(f"Bad Content-Range for {m.url_str}: {res.getheader('Content-Range')}")
+                m.size = int(mt.group(1))
+                self.update_stats(t1 - t0, len(data or b""), time.time() - t1, m)
+                if data:
+                    self.progress(len(data))
+                return data
+
+            raise Exception("Maximum number of redirects reached")
+
+    def range_headers(self, m, spec):
+        headers = {
+            "Connection": "keep-alive",
+            "Range": f"bytes={spec}",
+        }
+        # Pin every range to the object we first saw. A server that no
+        # longer has it answers with the whole (new) object instead.
+        if m.etag and not m.etag.startswith("W/"):
+            headers["If-Range"] = m.etag
+        elif m.last_modified:
+            headers["If-Range"] = m.last_modified
+        return headers
+
+    def check_validator(self, m, res):
+        etag = res.getheader("ETag", None)
+        last_modified = res.getheader("Last-Modified", None)
+        if m.etag is not None and etag is not None:
+            if etag != m.etag:
+                raise RemoteChanged(f"ETag changed from {m.etag} to {etag}")
+        elif m.last_modified is not None and last_modified is not None:
+            if last_modified != m.last_modified:
+                raise RemoteChanged(f"Last-Modified changed from {m.last_modified} to {last_modified}")
+
+    def check_response(self, m, res, off):
+        self.check_validator(m, res)
+        crange = res.getheader("Content-Range", "")
+        if res.status == 206 and crange.startswith(f"bytes {off}-"):
+            return
+        if res.status == 200 and off == 0:
+            return
+        if res.status == 200:
+            # Either If-Range did not match, or the server ignores Range.
+            # Only the validator tells them apart.
+            if ((m.etag and res.getheader("ETag", None) is None) or
+                (not m.etag and m.last_modified and res.getheader("Last-Modified", None) is None)):
+                raise RemoteChanged(f"Server sent the whole object instead of range {off}-")
+            raise RangesNotSupported(f"{m.url_str} does not support range requests")
+        raise Exception(f"Unexpected response {res.status} {crange}")
+
+    def get_partial(self, off, buf, bypass_cache=False, xfer=None, prio=BLOCKING, boost=None):
+        # Fetches len(buf) bytes at off into buf and returns how many bytes
+        # arrived. If the transfer breaks after some data has been received,
+        # or is moved to a faster mirror, that much is returned instead of
+        # raising, so it can be kept.
+        m = self.pick_mirror(len(buf))
+        if m.peer:
+            try:
+                return self.get_partial_from(m, off, buf, bypass_cache, xfer, prio, boost)
+            except PeerMiss as e:
+                # The peer does not have it (yet), which is not an error
+                logging.info(f"Peer cache miss for range {off}-{off+len(buf)-1}: {e}")
+                if xfer is not None and xfer.cancelled:
+                    return 0
+                m = self.pick_mirror(len(buf), peers=False)
+        return self.get_partial_from(m, off, buf, bypass_cache, xfer, prio, boost)
 
-        size = min(off + size, self.size) - off
-        retries = 10
-        sleep = 1
-        for retry in range(retries + 1):
+    def get_partial_from(self, m, off, buf, bypass_cache, xfer, prio, boost):
+        size = len(buf)
+        path = m.path
+        if bypass_cache:
+            path += f"{'&' if m.url.query else '?'}{random.random()}"
+
+        with scheduler.slot(self.priority(prio), boost):
+            res = None
+            got = 0
+            con = self.get_con(m)
             try:
-                data = self.get_partial(off, size, bypass_cache=(retry == retries))
+                if xfer is not None:
+                    xfer.attach(con)
+                t0 = time.time()
+                con.request("GET", path, headers=self.range_headers(m, f"{off}-{off+size-1}"))
+                res = con.getresponse()
+                t1 = time.time()
+                self.check_response(m, res, off)
+                while got < size:
+                    n = res.readinto(buf[got:got + self.CHUNK])
+                    if not n:
+                        break
+                    got += n
+                    if got < size and self.too_slow(m, got, time.time() - t1):
+                        self.drop_con(con)
+                        return got
+                t2 = time.time()
+                if xfer is not None:
+                    xfer.detach()
             except Exception as e:
-                if retry == retries:
-                    p_error(f"Exceeded maximum retries downloading data.")
+                if xfer is not None:
+                    xfer.detach()
+                self.drop_con(con)
+                if xfer is not None and xfer.cancelled:
+                    return got
+                if got:
+                    logging.warning(f"Transfer of {m.url_str} range {off}-{off+size-1} "
+                                    f"interrupted after {got} bytes: {e}")
+                    if not m.peer:
+                        self.update_error()
+                    return got
+                if m.peer:
+                    raise PeerMiss(str(e)) from e
+                with self.stats_lock:
+                    m.failures += 1
+                logging.error(f"Request failed for {m.url_str} range {off}-{off+size-1}")
+                if res is not None:
+                    logging.error(f"Response headers: {res.headers.as_string()}")
+                raise
+
+            if res.isclosed() and (xfer is None or not xfer.cancelled):
+                self.put_con(con)
+            else:
+                # e.g. the whole object was sent and we only wanted the start
+                self.drop_con(con)
+
+            if not got:
+                raise Exception(f"Server returned no data for for {m.url_str} range {off}-{off+size-1}")
+
+            self.update_stats(t1 - t0, got, t2 - t1, m)
+            return got
+
+    def hedge_deadline(self, size):
+        # How long a request for size bytes may take before it is hedged,
+        # or None if it should not be
+        with self.stats_lock:
+            if len(self.latencies) < self.HEDGE_SAMPLES:
+                return None
+            if self.hedge_bytes + size > self.bytes_fetched * self.HEDGE_BUDGET:
+                return None
+            lat = sorted(self.latencies)[int((len(self.latencies) - 1) * self.HEDGE_PERCENTILE)]
+        return max(self.HEDGE_MIN, lat * max(size, self.BLOCKSIZE) / self.BLOCKSIZE)
+
+    def get_hedged(self, off, buf, bypass_cache=False, prio=BLOCKING, boost=None):
+        # get_partial(), with a duplicate request racing the first one if it
+        # is taking too long.
+        size = len(buf)
+        deadline = self.hedge_deadline(size)
+        if deadline is None:
+            return self.get_partial(off, buf, bypass_cache, None, prio, boost)
+
+        with self.lock:
+            if self.hedge_pool is None:
+                self.hedge_pool = ThreadPoolExecutor(max_workers=2 * self.connections)
+        first = Transfer()
+        f1 = self.hedge_pool.submit(self.get_partial, off, buf, bypass_cache, first, prio, boost)
+        # The latency samples start when a request is sent, so does the
+        # deadline. Time spent waiting for a slot is not slowness.
+        f1.add_done_callback(lambda f: first.sent.set())
+        first.sent.wait()
+        if not f1.done():
+            wait([f1], timeout=max(0, deadline - (time.time() - first.sent_time)))
+        if f1.done():
+            return f1.result()
+
+        with self.stats_lock:
+            if self.hedge_bytes + size > self.bytes_fetched * self.HEDGE_BUDGET:
+                return f1.result()
+            self.hedge_bytes += size
+            self.hedged += 1
+        logging.info(f"Range {off}-{off+size-1} of {self.url_str} is slow "
+                     f"(>{deadline:.2f}s), hedging")
+
+        # The duplicate gets its own buffer, the first request may still be
+        # writing into ours
+        buf2 = memoryview(bytearray(size))
+        second = Transfer()
+        f2 = self.hedge_pool.submit(self.get_partial, off, buf2, bypass_cache, second, prio, boost)
+
+        winner = None
+        pending = {f1, f2}
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for f in (f1, f2):
+                if f in done and f.exception() is None and f.result() == size:
+                    winner = f
+                    break
+        if winner is None:
+            # Neither got everything, keep whichever got more
+            ok = [f for f in (f1, f2) if f.exception() is None]
+            if not ok:
+                raise f1.exception()
+            winner = max(ok, key=lambda f: f.result())
+
+        if winner is f1:
+            second.cancel()
+            return f1.result()
+
+        first.cancel()
+        wait([f1])
+        n = f2.result()
+        buf[:n] = buf2[:n]
+        with self.stats_lock:
+            self.hedges_won += 1
+        return n
+
+    def ewma(self, old, sample):
+        if old is None:
+            return sample
+        return old + self.EWMA_ALPHA * (sample - old)
+
+    def update_stats(self, rtt, nbytes, xfer, m):
+        with self.stats_lock:
+            # Latency samples are normalized to one block's worth
+            self.latencies.append((rtt + xfer) * self.BLOCKSIZE / max(nbytes, self.BLOCKSIZE))
+            self.bytes_fetched += nbytes
+            m.failures = 0
+            m.rtt = self.ewma(m.rtt, rtt)
+            self.rtt = self.ewma(self.rtt, rtt)
+            # Tiny transfers say nothing about bandwidth
+            if nbytes >= self.BLOCKSIZE and xfer > 0:
+                m.bw = self.ewma(m.bw, nbytes / xfer)
+                self.bw = self.ewma(self.bw, nbytes / xfer)
+            if self.bw is None:
+                return
+
+            # Size the whole window (all connections together) from the
+            # bandwidth-delay product, growing at most 2x per success so
+            # that we ramp back up gradually after errors.
+            target = self.bw * self.rtt * self.BDP_FACTOR * self.connections
+            target = int(target // self.BLOCKSIZE)
+            target = max(self.MIN_READAHEAD, min(self.MAX_READAHEAD, target))
+            self.readahead = min(target, self.readahead * 2)
+
+    def update_error(self):
+        with self.stats_lock:
+            self.readahead = max(self.MIN_READAHEAD, self.readahead // 2)
+
+    def progress(self, nbytes):
+        with self.lock:
+            self.spin = (self.spin + 1) % len(self.SPINNER)
+            sys.stdout.write(f"\r{self.SPINNER[self.spin]} ")
+            sys.stdout.flush()
+            self.blocks_read += 1
+            self.bytes_read += nbytes
+
+    def fill(self, cursor, off, end, streaming):
+        # Fetch at least some of [off, end), which starts with a gap in the
+        # cache. Sequential reads also fetch the readahead window after it.
+        need_end = min(end, off + self.MAX_READAHEAD * self.BLOCKSIZE)
+        if streaming:
+            start = off
+            fend = align_up(max(need_end, off + self.readahead * self.BLOCKSIZE), self.BLOCKSIZE)
+        else:
+            start = align_down(off, self.SMALL_ALIGN)
+            fend = align_up(need_end, self.SMALL_ALIGN)
+        fend = min(fend, self.size)
+
+        with self.lock:
+            self.load_stored(start, fend)
+
+        if cursor.stream is not None:
+            # The stream reads ahead by itself, only wait for what is needed
+            if self.stream_fill(cursor, off, need_end):
+                return
+
+        # Split the gaps into adjacent ranges, one per connection, and fetch
+        # them concurrently. Ranges the reader is not waiting for are
+        # prefetch. Gaps that another reader is already fetching are left
+        # to it, and waited for if we need them.
+        waits = []
+        ranges = []
+        with self.lock:
+            for gstart, gend in self.cache.missing(start, fend):
+                for gstart, gend in self.claim(gstart, gend, off, need_end, waits):
+                    ranges += self.split_lanes(gstart, gend)
+            for roff, rsize in ranges:
+                self.inflight[roff] = (roff + rsize, Future(), threading.Event())
+        prios = [BLOCKING if roff < need_end else PREFETCH for roff, rsize in ranges]
+
+        def fetch(r, prio):
+            roff, rsize = r
+            try:
+                data = self.fetch_range(roff, rsize, prio, self.inflight[roff][2])
+                self.progress(len(data))
+                with self.lock:
+                    self.add_span(roff, data)
+            except Exception as e:
+                if prio == BLOCKING:
                     raise
-                p_warning(f"Error downloading data ({e}), retrying... ({retry + 1}/{retries})")
-                time.sleep(sleep)
-                self.close_connection()
-                sleep += 1
-                # Retry in smaller chunks after a couple errors
-                if retry > 0:
-                    self.readahead = self.MIN_READAHEAD
-                size = min(size, self.readahead * self.BLOCKSIZE)
+                # Whoever needs this range later fetches it again
+                logging.info(f"Readahead at {roff} for {self.url_str} failed: {e}")
+            finally:
+                with self.lock:
+                    _, future, _ = self.inflight.pop(roff)
+                future.set_result(None)
+
+        # Only wait for what the reader needs, the readahead carries on in
+        # the background
+        need = [r for r, prio in zip(ranges, prios) if prio == BLOCKING]
+        ahead = [r for r, prio in zip(ranges, prios) if prio != BLOCKING]
+        for r in ahead:
+            self.get_executor(PREFETCH).submit(fetch, r, PREFETCH)
+        if len(need) == 1:
+            fetch(need[0], BLOCKING)
+        elif need:
+            list(self.get_executor().map(fetch, need, [BLOCKING] * len(need)))
+
+        # We are blocked on whatever others are fetching for us, so it is
+        # no longer speculative. The caller looks again once it is done.
+        for future, boost in waits:
+            scheduler.boost(boost)
+        wait([future for future, boost in waits])
+
+    def split_lanes(self, start, end):
+        # Split [start, end) into adjacent (offset, size) ranges, one per
+        # connection, if it is long enough to be worth it
+        nblocks = (end - start) // self.BLOCKSIZE
+        lanes = max(1, min(self.connections, nblocks // self.MIN_SPLIT))
+        # Cut on block boundaries, so every whole block can be stored
+        step = (end - start) // lanes
+        cuts = ([start] +
+                [align_down(start + i * step, self.BLOCKSIZE) for i in range(1, lanes)] +
+                [end])
+        return [(a, b - a) for a, b in zip(cuts, cuts[1:]) if b > a]
+
+    def load_stored(self, start, end):
+        # Bring blocks of [start, end) that are missing from the cache in
+        # from the block store. Called with the lock held.
+        if self.store is None:
+            return
+        for gstart, gend in self.cache.missing(start, end):
+            for blk in range(gstart // self.BLOCKSIZE, (gend - 1) // self.BLOCKSIZE + 1):
+                if self.store.has(blk):
+                    data = self.store.get(blk)
+                    if data is not None:
+                        self.cache.add(blk * self.BLOCKSIZE, data)
+
+    def claim(self, start, end, need_start, need_end, waits):
+        # Returns the parts of [start, end) that nobody is fetching yet.
+        # Fetches in flight that overlap [need_start, need_end) are added to
+        # waits, as (future, boost event) pairs.
+        parts = [(start, end)]
+        for istart, (iend, future, boost) in self.inflight.items():
+            if istart >= end or iend <= start:
+                continue
+            if istart < need_end and iend > need_start:
+                waits.append((future, boost))
+            parts = [(a, b) for pstart, pend in parts
+                     for a, b in ((pstart, min(pend, istart)), (max(pstart, iend), pend))
+                     if b > a]
+        return parts
+
+    def stream_fill(self, cursor, off, end):
+        # Take the gaps in [off, end) from the stream. Returns False if the
+        # stream could not provide them.
+        with self.lock:
+            gaps = self.cache.missing(off, end)
+        for gstart, gend in gaps:
+            for blk in range(gstart // self.BLOCKSIZE, (gend - 1) // self.BLOCKSIZE + 1):
+                data = cursor.stream.get(blk, self.readahead)
+                if data is None:
+                    # Stream failed or is behind us, go back to ranged
+                    # requests for a while
+                    self.close_stream(cursor)
+                    cursor.stream_after = (blk * self.BLOCKSIZE) + self.STREAM_THRESHOLD
+                    return False
+                self.progress(len(data))
+                with self.lock:
+                    self.add_span(blk * self.BLOCKSIZE, data)
+        return True
+
+    def close_stream(self, cursor):
+        if cursor.stream is not None:
+            cursor.stream.close()
+            cursor.stream = None
+
+    def fetch_range(self, off, size, prio=BLOCKING, boost=None):
+        # Returns at least min(size, BLOCKSIZE) bytes at off. After errors
+        # the request may be cut short, so callers must cope with less than
+        # size bytes. Setting boost (with scheduler.boost()) makes a queued
+        # speculative request blocking.
+        policy = self.retry
+        buf = memoryview(bytearray(size))
+        got = 0
+        failures = 0
+        bypass = False
+        while got < size:
+            try:
+                n = self.get_hedged(off + got, buf[got:size],
+                                    bypass_cache=(bypass or failures == policy.retries),
+                                    prio=prio, boost=boost)
+            except RangesNotSupported as e:
+                # Retrying will not help
+                p_error(f"The server does not support range requests.")
+                raise
+            except Exception as e:
+                error = e
+                # Likely a stale cache or CDN edge, try to go around it.
+                # Nothing from the mismatched response was kept.
+                bypass = isinstance(e, RemoteChanged)
             else:
+                # Keep what arrived and only ask for the rest. Anything that
+                # makes progress does not count as a failure.
+                got += n
+                failures = 0
+                continue
+
+            if failures == policy.retries:
+                if isinstance(error, RemoteChanged):
+                    p_error(f"The file on the server changed while it was being downloaded.")
+                p_error(f"Exceeded maximum retries downloading data.")
+                raise error
+            failures += 1
+            p_warning(f"Error downloading data ({error}), retrying... ({failures}/{policy.retries})")
+            time.sleep(policy.delay(failures - 1))
+            # Retry in smaller chunks, the window grows back on success
+            self.update_error()
+            size = min(size, got + self.readahead * self.BLOCKSIZE)
+
+        return buf[:got]
+
+    def add_span(self, off, data):
+        # Cache a byte range, and record the whole blocks in it in the store
+        self.cache.add(off, data)
+        if self.store is None:
+            return
+        end = off + len(data)
+        bstart = align_up(off, self.BLOCKSIZE)
+        bend = align_down(end, self.BLOCKSIZE)
+        if end == self.size:
+            bend = end
+        for boff in range(bstart, bend, self.BLOCKSIZE):
+            self.store.put(boff // self.BLOCKSIZE, data[boff - off:boff - off + self.BLOCKSIZE])
+
+    def get_multi(self, spans, prio=BLOCKING, boost=None):
+        # One request for several ranges. Returns a list of (offset, data)
+        # pieces, which may cover only part of what was asked for if the
+        # server chose to ignore or merge some of the ranges.
+        m = self.pick_mirror(sum(size for off, size in spans))
+        if m.peer:
+            try:
+                return self.get_multi_from(m, spans, prio, boost)
+            except PeerMiss as e:
+                logging.info(f"Peer cache miss for {len(spans)} ranges: {e}")
+                m = self.pick_mirror(sum(size for off, size in spans), peers=False)
+        return self.get_multi_from(m, spans, prio, boost)
+
+    def get_multi_from(self, m, spans, prio, boost):
+        hdr = ",".join(f"{off}-{off + size - 1}" for off, size in spans)
+        with scheduler.slot(self.priority(prio), boost):
+            res = None
+            con = self.get_con(m)
+            try:
+                t0 = time.time()
+                con.request("GET", m.path, headers=self.range_headers(m, hdr))
+                res = con.getresponse()
+                t1 = time.time()
+                self.check_validator(m, res)
+                if res.status != 206 and m.peer:
+                    raise PeerMiss(f"HTTP {res.status} {res.reason}")
+                if res.status != 206:
+                    # Server ignored the Range header, don't read the whole body
+                    self.drop_con(con)
+                    logging.info(f"Multi-range request for {m.url_str} got status {res.status}")
+                    return []
+                body = res.read()
+                t2 = time.time()
+            except Exception as e:
+                self.drop_con(con)
+                if m.peer:
+                    raise PeerMiss(str(e)) from e
+                logging.error(f"Request failed for {m.url_str} ranges {hdr}")
+                if res is not None:
+                    logging.error(f"Response headers: {res.headers.as_string()}")
+                raise
+
+            self.put_con(con)
+            self.update_stats(t1 - t0, len(body), t2 - t1, m)
+
+            if res.headers.get_content_type() != "multipart/byteranges":
+                mt = re.match(r"bytes (\d+)-(\d+)/", res.getheader("Content-Range", ""))
+                if not mt:
+                    return []
+                return [(int(mt.group(1)), memoryview(body))]
+
+            boundary = res.headers.get_param("boundary")
+            if not boundary:
+                return []
+            return self.parse_multipart(body, b"--" + boundary.encode())
+
+    def parse_multipart(self, raw, delim):
+        pieces = []
+        body = memoryview(raw)
+        p = raw.find(delim)
+        while p >= 0:
+            p += len(delim)
+            if raw[p:p + 2] == b"--":
+                break
+            hend = raw.find(b"\r\n\r\n", p)
+            if hend < 0:
                 break
+            headers = raw[p:hend].decode("latin-1")
+            m = re.search(r"content-range:\s*bytes\s+(\d+)-(\d+)/", headers, re.I)
+            if not m:
+                break
+            start, end = int(m.group(1)), int(m.group(2)) + 1
+            p = hend + 4
+            pieces.append((start, body[p:p + end - start]))
+            p = raw.find(delim, p + end - start)
+        return pieces
 
-        off = 0
-        blk2 = blk
+    def prefetch(self, ranges, prio=PREFETCH):
+        # Bring several (offset, length) ranges into the cache with as few
+        # requests as possible. Ranges that are not cached yet are coalesced
+        # and fetched with multi-range requests, falling back to one request
+        # per range if the server does not support that. Earlier ranges in
+        # the list are fetched first.
+        with self.lock:
+            for off, size in ranges:
+                self.load_stored(off, off + size)
+            gaps = [(gstart, gend, i) for i, (off, size) in sorted(enumerate(ranges), key=lambda r: r[1])
+                    for gstart, gend in self.cache.missing(off, off + size)]
 
-        while off < len(data):
-            self.cache[blk2] = CacheBlock(idx=blk2, data=data[off:off + self.BLOCKSIZE])
-            off += self.BLOCKSIZE
-            blk2 += 1
+        missing = []
+        for gstart, gend, i in gaps:
+            start = align_down(gstart, self.SMALL_ALIGN)
+            end = min(align_up(gend, self.SMALL_ALIGN), self.size)
+            if missing and start <= missing[-1][1] + self.COALESCE_GAP:
+                missing[-1][1] = max(missing[-1][1], end)
+                missing[-1][2] = min(missing[-1][2], i)
+            else:
+                missing.append([start, end, i])
+        missing.sort(key=lambda m: m[2])
 
-        return self.cache[blk]
+        # Register what nobody else is fetching yet as in flight, so readers
+        # wait for it instead of asking again. Small spans share multi-range
+        # requests, large ones are split across connections like in fill().
+        batches = []
+        small = []
+        small_boost = threading.Event()
+        with self.lock:
+            for start, end, i in missing:
+                for a, b in self.claim(start, end, 0, 0, []):
+                    if (b - a) // self.BLOCKSIZE < self.MIN_SPLIT:
+                        small.append((a, b - a))
+                        self.inflight[a] = (b, Future(), small_boost)
+                        if len(small) == self.MAX_RANGES:
+                            batches.append(small)
+                            small = []
+                            small_boost = threading.Event()
+                        continue
+                    for roff, rsize in self.split_lanes(a, b):
+                        batches.append([(roff, rsize)])
+                        self.inflight[roff] = (roff + rsize, Future(), threading.Event())
+        if small:
+            batches.append(small)
 
-    def seek(self, offset, whence=os.SEEK_SET):
+        def fetch(batch):
+            boost = self.inflight[batch[0][0]][2]
+            try:
+                if len(batch) == 1:
+                    pieces = [(batch[0][0], self.fetch_range(*batch[0], prio, boost))]
+                else:
+                    try:
+                        pieces = self.get_multi(batch, prio, boost)
+                    except Exception as e:
+                        p_warning(f"Multi-range request failed ({e}), retrying ranges individually...")
+                        pieces = []
+                    for off, size in batch:
+                        if not any(o <= off and off + size <= o + len(d) for o, d in pieces):
+                            pieces.append((off, self.fetch_range(off, size, prio, boost)))
+                for off, data in pieces:
+                    self.progress(len(data))
+                    with self.lock:
+                        self.add_span(off, data)
+            finally:
+                for off, size in batch:
+                    with self.lock:
+                        _, future, _ = self.inflight.pop(off)
+                    future.set_result(None)
+
+        if len(batches) > 1:
+            list(self.get_executor(prio).map(fetch, batches))
+        elif batches:
+            fetch(batches[0])
+
+    def readv(self, ranges):
+        # Read several (offset, length) ranges, fetching the missing ones
+        # together
+        self.prefetch(ranges)
+        return [self.pread(off, size) for off, size in ranges]
+
+    def replay_trace(self):
+        plan = self.trace.plan
+        logging.info(f"Prefetching {len(plan)} ranges ({sum(s for o, s in plan)} bytes) "
+                     f"of {self.url_str} from {self.trace.path}")
+        try:
+            self.prefetch(plan)
+        except Exception as e:
+            # Only an optimization, readers fetch whatever is still missing
+            logging.info(f"Trace prefetch for {self.url_str} failed: {e}")
+
+    def pread(self, off, size):
+        # Thread-safe positional read, independent of any cursor
+        return self.cursor_read(Cursor(off), size)
+
+    def reader(self):
+        # A new file object with its own position, for another thread
+        reader = URLCacheReader(self)
+        self.readers.add(reader)
+        return reader
+
+    def cursor_seek(self, cursor, offset, whence):
         if whence == os.SEEK_SET:
-            self.p = offset
+            cursor.p = offset
         elif whence == os.SEEK_END:
-            self.p = self.size + offset
+            cursor.p = self.size + offset
         elif whence == os.SEEK_CUR:
-            self.p += offset
+            cursor.p += offset
+        return cursor.p
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.cursor_seek(self.cursor, offset, whence)
 
     def tell(self):
-        return self.p
+        return self.cursor.p
 
-    def read(self, count=None):
-        if count is None:
-            count = self.size - self.p
+    def readable(self):
+        return True
 
-        blk_start = self.p // self.BLOCKSIZE
-        blk_end = (self.p + count - 1) // self.BLOCKSIZE
+    def get_parts(self, cursor, count):
+        # Returns the next count bytes at the cursor as a list of views into
+        # the cache, without copying anything.
+        off, end = cursor.p, cursor.p + count
+        sequential = off == cursor.last_end
+        if not sequential:
+            cursor.seq_bytes = 0
+            self.close_stream(cursor)
+        streaming = cursor.seq_bytes >= self.SEQ_THRESHOLD
+        if self.trace is not None and not streaming:
+            # Only the first SEQ_THRESHOLD bytes of a run, the trace is for
+            # latency-bound small reads, not bulk data (like the first
+            # fdcopy() chunk of a member)
+            self.trace.record(off, min(count, self.SEQ_THRESHOLD - cursor.seq_bytes))
+        cursor.seq_bytes += count
 
-        blocks = blk_end - blk_start + 1
+        with self.lock:
+            if (cursor.stream is None and self.STREAM_THRESHOLD is not None and
+                cursor.seq_bytes >= self.STREAM_THRESHOLD and off >= cursor.stream_after):
+                gaps = self.cache.missing(off, self.size)
+                if gaps:
+                    blk = gaps[0][0] // self.BLOCKSIZE
+                    logging.info(f"Streaming {self.url_str} from block {blk}")
+                    cursor.stream = Stream(self, blk)
 
-        d = []
-        for blk in range(blk_start, blk_end + 1):
-            readahead = blk_end - blk + 1
-            d.append(self.get_block(blk, readahead).data)
-            prog = (blk - blk_start + 1) / blocks * 100
-            self.blocks_read += 1
+            missing = sum(gend - gstart for gstart, gend in self.cache.missing(off, end))
+            if missing:
+                self.misses += 1
+                self.miss_bytes += missing
+            else:
+                self.hits += 1
+            self.hit_bytes += count - missing
+
+        parts = []
+        pos = off
+        while pos < end:
+            with self.lock:
+                got = self.cache.prefix(pos, end)
+            if not got:
+                self.fill(cursor, pos, end, streaming)
+                continue
+            parts += got
+            pos += sum(len(i) for i in got)
+
+        with self.lock:
+            if sequential:
+                # Extents a streaming read has fully consumed are not going
+                # to be needed again, so drop them instead of letting them
+                # age out.
+                self.cache.discard(off, end)
+            else:
+                self.cache.promote(off, end)
+
+        cursor.p = end
+        cursor.last_end = end
+        return parts
+
+    def cursor_read(self, cursor, count=None):
+        if count is None or count < 0:
+            count = self.size - cursor.p
+        count = min(count, self.size - cursor.p)
+        if count <= 0:
+            return b""
+
+        # The join is the only copy between the socket buffer and the caller
+        return b"".join(self.get_parts(cursor, count))
+
+    def cursor_readinto(self, cursor, b):
+        count = min(len(b), self.size - cursor.p)
+        if count <= 0:
+            return 0
+
+        out = memoryview(b).cast("B")
+        pos = 0
+        for part in self.get_parts(cursor, count):
+            out[pos:pos + len(part)] = part
+            pos += len(part)
+        return pos
+
+    def read(self, count=None):
+        return self.cursor_read(self.cursor, count)
 
-        trim = self.p - (blk_start * self.BLOCKSIZE)
-        d[0] = d[0][trim:]
+    def readall(self):
+        return self.read()
 
-        d = b"".join(d)[:count]
-        assert len(d) == count
-        self.p += count
-        return d
+    def readinto(self, b):
+        return self.cursor_readinto(self.cursor, b)
+
+    def close(self):
+        if self.closed:
+            return
+        self.close_stream(self.cursor)
+        for reader in list(self.readers):
+            reader.close()
+        # The pooled connections are not ours, other instances (or the next
+        # one to the same host) reuse them
+        self.log_stats()
+        if self.trace is not None:
+            self.trace.save()
+        if self.readahead_pool is not None:
+            self.readahead_pool.shutdown(wait=False, cancel_futures=True)
+        if self.hedge_pool is not None:
+            self.hedge_pool.shutdown(wait=False)
+        # Readahead still running only goes to the memory cache now
+        with self.lock:
+            store, self.store = self.store, None
+        if store is not None:
+            store.close()
+        super().close()
 
     def flush_progress(self):
         if self.blocks_read > 0:
@@ -212,13 +1990,48 @@ class URLCache:
         else:
             return False
 
+class URLCacheReader(io.RawIOBase):
+    # An independent cursor over a URLCache, sharing its cache and
+    # connections. Each thread should use its own.
+    def __init__(self, ucache):
+        super().__init__()
+        self.ucache = ucache
+        self.cursor = Cursor()
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.ucache.cursor_seek(self.cursor, offset, whence)
+
+    def tell(self):
+        return self.cursor.p
+
+    def read(self, count=None):
+        return self.ucache.cursor_read(self.cursor, count)
+
+    def readall(self):
+        return self.read()
+
+    def readinto(self, b):
+        return self.ucache.cursor_readinto(self.cursor, b)
+
+    def close(self):
+        if self.closed:
+            return
+        self.ucache.close_stream(self.cursor)
+        super().close()
+
 if __name__ == "__main__":
-    import sys, zipfile
+    import sys, zipindex
     from util import PackageInstaller
 
     url = sys.argv[1]
     ucache = URLCache(url)
-    zf = zipfile.ZipFile(ucache)
+    zf = zipindex.IndexedZipFile(ucache)
 
     pi = PackageInstaller()
     pi.ucache = ucache
@@ -1,5 +1,5 @@
 # SPDX-License-Identifier: MIT
-import re, logging, sys, os, stat, shutil, struct, subprocess, zlib, time, hashlib, lzma
+import re, logging, sys, os, stat, shutil, struct, subprocess, zlib, time, hashlib, lzma, zipindex
 from ctypes import *
 
 if sys.platform == 'darwin':
@@ -175,6 +175,12 @@ class PBZX:
         return d
 
 class PackageInstaller:
+    # Prefetching stops at this many bytes (or half the URLCache budget),
+    # members beyond that are streamed when they are extracted
+    PREFETCH_BUDGET = 128 * 1024 * 1024
+    # Wanted members closer than this are fetched as one span, gap included
+    PREFETCH_GAP = 64 * 1024
+
     def __init__(self):
         self.verbose = "-v" in sys.argv
         self.printed_progress = False
@@ -190,6 +196,74 @@ class PackageInstaller:
             sys.stdout.write("\n")
             self.printed_progress = False
 
+    def open_package(self):
+        # The zip index of a remote package is kept with its metadata, so
+        # that later runs need not fetch and parse the central directory
+        index = None
+        data = self.ucache.load_meta("zipindex")
+        if data is not None:
+            try:
+                index = zipindex.ZipIndex.load(data)
+                logging.info(f"Using cached zip index ({len(index)} entries)")
+            except Exception as e:
+                logging.warning(f"Ignoring cached zip index: {e}")
+        pkg = zipindex.IndexedZipFile(self.ucache, index)
+        if index is None:
+            self.ucache.save_meta("zipindex", pkg.index.dump())
+        return pkg
+
+    def prefetch(self, names, trees=()):
+        # Fetch the named members and everything under the trees ahead of
+        # extraction, in as few requests as possible
+        infos = []
+        for name in names:
+            try:
+                infos.append(self.pkg.getinfo(self.path(name)))
+            except KeyError:
+                pass
+        for tree in trees:
+            src = self.path(tree)
+            if src[-1] != "/":
+                src += "/"
+            infos += self.pkg.tree(src)
+        self.prefetch_infos(infos)
+
+    def plan(self, infos):
+        # Returns the (offset, size) spans holding the local headers and data
+        # of infos, sorted by offset and with small gaps merged. Members are
+        # taken in the given order until the budget runs out.
+        budget = min(self.PREFETCH_BUDGET, self.ucache.cache.limit // 2)
+        extents = []
+        seen = set()
+        for info in infos:
+            if info.is_dir() or info.filename in seen:
+                continue
+            seen.add(info.filename)
+            start, end = self.pkg.extent(info.filename)
+            if end - start > budget:
+                continue
+            budget -= end - start
+            extents.append((start, end))
+        extents.sort()
+
+        spans = []
+        for start, end in extents:
+            if spans and start <= spans[-1][1] + self.PREFETCH_GAP:
+                spans[-1][1] = max(spans[-1][1], end)
+            else:
+                spans.append([start, end])
+        return [(start, end - start) for start, end in spans]
+
+    def prefetch_infos(self, infos):
+        if not self.ucache or len(infos) < 2:
+            return
+
+        spans = self.plan(infos)
+        if spans:
+            total = sum(size for off, size in spans)
+            logging.info(f"  Prefetching {len(infos)} members in {len(spans)} spans ({total} bytes)")
+            self.ucache.prefetch(spans)
+
     def extract(self, src, dest):
         dest_path = os.path.join(dest, src)
         dest_dir = os.path.split(dest_path)[0]
@@ -331,14 +405,13 @@ class PackageInstaller:
             src += "/"
         logging.info(f"  {src}* -> {dest}")
 
-        infolist = self.pkg.infolist()
+        infolist = self.pkg.tree(src)
+        self.prefetch_infos(infolist)
         if self.verbose:
             self.flush_progress()
 
         for info in infolist:
             name = info.filename
-            if not name.startswith(src):
-                continue
             subpath = name[len(src):]
             assert subpath[0:1] != "/"
 
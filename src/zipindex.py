@@ -0,0 +1,258 @@
+# SPDX-License-Identifier: MIT
+import bisect, json, struct, zipfile
+from array import array
+
+class ZipIndex:
+    # The central directory of a zip file, kept as the raw bytes plus one
+    # entry per member in arrays sorted by name. Packages have tens of
+    # thousands of members, and zipfile would build a ZipInfo for each of
+    # them up front; here they are only built for the members asked for.
+    MAGIC = b"ZIPINDEX1\n"
+    ARRAYS = ("rec", "offset", "csize", "size", "crc", "method", "attr")
+    # The local header extra field can differ from the central directory one
+    LOCAL_SLACK = 1024
+
+    def __init__(self, cd, concat=0, comment=b"", start_dir=0):
+        self.cd = cd
+        self.comment = comment
+        self.start_dir = start_dir
+
+        names = []
+        rec = array("Q")
+        offset = array("Q")
+        csize = array("Q")
+        size = array("Q")
+        crc = array("L")
+        method = array("H")
+        attr = array("L")
+
+        p = 0
+        while p < len(cd):
+            if len(cd) - p < zipfile.sizeCentralDir:
+                raise zipfile.BadZipFile("Truncated central directory")
+            centdir = struct.unpack_from(zipfile.structCentralDir, cd, p)
+            if centdir[0] != zipfile.stringCentralDir:
+                raise zipfile.BadZipFile("Bad magic number for central directory")
+            nlen, elen, clen = centdir[12:15]
+            name = self.decode(cd, p, centdir)
+            # Same as ZipInfo does to the name
+            if "\0" in name:
+                name = name[:name.index("\0")]
+
+            sizes = [centdir[11], centdir[10], centdir[18]]
+            if 0xffffffff in sizes:
+                self.decode_zip64(cd, p + zipfile.sizeCentralDir + nlen, elen, sizes)
+
+            names.append(name)
+            rec.append(p)
+            size.append(sizes[0])
+            csize.append(sizes[1])
+            offset.append(sizes[2] + concat)
+            crc.append(centdir[9])
+            method.append(centdir[6])
+            attr.append(centdir[17])
+            p += zipfile.sizeCentralDir + nlen + elen + clen
+
+        # The sort is stable, so with duplicate names the last one wins
+        # like in zipfile
+        order = sorted(range(len(names)), key=names.__getitem__)
+        self.names = [names[i] for i in order]
+        self.rec = array("Q", (rec[i] for i in order))
+        self.offset = array("Q", (offset[i] for i in order))
+        self.csize = array("Q", (csize[i] for i in order))
+        self.size = array("Q", (size[i] for i in order))
+        self.crc = array("L", (crc[i] for i in order))
+        self.method = array("H", (method[i] for i in order))
+        self.attr = array("L", (attr[i] for i in order))
+        self.starts = None
+
+    @staticmethod
+    def decode(cd, p, centdir):
+        raw = cd[p + zipfile.sizeCentralDir:p + zipfile.sizeCentralDir + centdir[12]]
+        if centdir[5] & 0x800:
+            return bytes(raw).decode("utf-8")
+        return bytes(raw).decode("cp437")
+
+    @staticmethod
+    def decode_zip64(cd, p, elen, sizes):
+        # Fills in the 0xffffffff values of [size, compressed size, header
+        # offset] from the zip64 extra field, in that order
+        end = p + elen
+        while p + 4 <= end:
+            tag, length = struct.unpack_from("<HH", cd, p)
+            if tag == 1:
+                q = p + 4
+                for i in range(3):
+                    if sizes[i] == 0xffffffff:
+                        if q + 8 > p + 4 + length:
+                            raise zipfile.BadZipFile("Corrupt zip64 extra field")
+                        sizes[i] = struct.unpack_from("<Q", cd, q)[0]
+                        q += 8
+                return
+            p += 4 + length
+
+    @classmethod
+    def read(cls, fp):
+        endrec = zipfile._EndRecData(fp)
+        if not endrec:
+            raise zipfile.BadZipFile("File is not a zip file")
+        size_cd = endrec[zipfile._ECD_SIZE]
+        offset_cd = endrec[zipfile._ECD_OFFSET]
+        concat = endrec[zipfile._ECD_LOCATION] - size_cd - offset_cd
+        if endrec[zipfile._ECD_SIGNATURE] == zipfile.stringEndArchive64:
+            concat -= zipfile.sizeEndCentDir64 + zipfile.sizeEndCentDir64Locator
+        start_dir = offset_cd + concat
+        if start_dir < 0:
+            raise zipfile.BadZipFile("Bad offset for central directory")
+        fp.seek(start_dir)
+        cd = fp.read(size_cd)
+        if len(cd) != size_cd:
+            raise zipfile.BadZipFile("Truncated central directory")
+        return cls(cd, concat, endrec[zipfile._ECD_COMMENT], start_dir)
+
+    def dump(self):
+        # A flat serialization, which load() takes back without parsing
+        # the central directory again
+        parts = [self.cd, "\0".join(self.names).encode("utf-8", "surrogatepass")]
+        parts += [getattr(self, i).tobytes() for i in self.ARRAYS]
+        header = {
+            "count": len(self.names),
+            "start_dir": self.start_dir,
+            "comment": self.comment.hex(),
+            "types": [getattr(self, i).typecode + str(getattr(self, i).itemsize) for i in self.ARRAYS],
+            "lengths": [len(i) for i in parts],
+        }
+        return self.MAGIC + json.dumps(header).encode() + b"\n" + b"".join(parts)
+
+    @classmethod
+    def load(cls, data):
+        if not data.startswith(cls.MAGIC):
+            raise ValueError("Not a zip index")
+        p = data.index(b"\n", len(cls.MAGIC)) + 1
+        header = json.loads(data[len(cls.MAGIC):p])
+        parts = []
+        for length in header["lengths"]:
+            parts.append(data[p:p + length])
+            p += length
+        if p != len(data) or len(parts) != len(cls.ARRAYS) + 2:
+            raise ValueError("Truncated zip index")
+
+        self = cls.__new__(cls)
+        self.cd = parts[0]
+        self.comment = bytes.fromhex(header["comment"])
+        self.start_dir = header["start_dir"]
+        count = header["count"]
+        self.names = parts[1].decode("utf-8", "surrogatepass").split("\0") if count else []
+        if len(self.names) != count:
+            raise ValueError("Bad zip index names")
+        for name, typ, raw in zip(cls.ARRAYS, header["types"], parts[2:]):
+            a = array(typ[0])
+            if typ != a.typecode + str(a.itemsize):
+                raise ValueError("Zip index from another platform")
+            a.frombytes(raw)
+            if len(a) != count:
+                raise ValueError("Bad zip index arrays")
+            setattr(self, name, a)
+        self.starts = None
+        return self
+
+    def __len__(self):
+        return len(self.names)
+
+    def find(self, name):
+        i = bisect.bisect_right(self.names, name) - 1
+        if i < 0 or self.names[i] != name:
+            return None
+        return i
+
+    def prefix(self, prefix):
+        # The range of entries whose names start with prefix
+        lo = bisect.bisect_left(self.names, prefix)
+        # Every name with the prefix sorts before prefix + U+10FFFF
+        hi = bisect.bisect_left(self.names, prefix + "\U0010ffff", lo)
+        return lo, hi
+
+    def extent(self, i):
+        # The [start, end) range holding the local header, data and data
+        # descriptor of entry i. It ends at the next local header (or the
+        # central directory), unless that is further than what the sizes
+        # allow for.
+        if self.starts is None:
+            self.starts = array("Q", sorted(self.offset))
+        start = self.offset[i]
+        j = bisect.bisect_right(self.starts, start)
+        end = self.starts[j] if j < len(self.starts) else self.start_dir
+        nlen, elen = struct.unpack_from("<HH", self.cd, self.rec[i] + 28)
+        limit = (start + zipfile.sizeFileHeader + nlen + elen + self.LOCAL_SLACK +
+                 self.csize[i])
+        return start, max(start, min(end, limit))
+
+    def info(self, i):
+        p = self.rec[i]
+        centdir = struct.unpack_from(zipfile.structCentralDir, self.cd, p)
+        nlen, elen, clen = centdir[12:15]
+        x = zipfile.ZipInfo(self.decode(self.cd, p, centdir))
+        p += zipfile.sizeCentralDir + nlen
+        x.extra = bytes(self.cd[p:p + elen])
+        x.comment = bytes(self.cd[p + elen:p + elen + clen])
+        (x.create_version, x.create_system, x.extract_version, x.reserved,
+         x.flag_bits, x.compress_type, t, d) = centdir[1:9]
+        if x.extract_version > zipfile.MAX_EXTRACT_VERSION:
+            raise NotImplementedError(f"zip file version {x.extract_version / 10:.1f}")
+        x.volume, x.internal_attr, x.external_attr = centdir[15:18]
+        x._raw_time = t
+        x.date_time = ((d >> 9) + 1980, (d >> 5) & 0xf, d & 0x1f,
+                       t >> 11, (t >> 5) & 0x3f, (t & 0x1f) * 2)
+        x.CRC = self.crc[i]
+        x.compress_size = self.csize[i]
+        x.file_size = self.size[i]
+        x.header_offset = self.offset[i]
+        return x
+
+class IndexedZipFile(zipfile.ZipFile):
+    # A read-only ZipFile backed by a ZipIndex. ZipInfo objects are made
+    # on demand, and infolist() is in name order.
+    def __init__(self, file, index=None):
+        # index may be a ZipIndex loaded from elsewhere, for this file
+        self.index = index
+        super().__init__(file, "r")
+
+    def _RealGetContents(self):
+        if self.index is None:
+            self.index = ZipIndex.read(self.fp)
+        self.start_dir = self.index.start_dir
+        self._comment = self.index.comment
+
+    def info_at(self, i):
+        names = self.index.names
+        name = names[i]
+        if i + 1 < len(names) and names[i + 1] == name:
+            # An earlier duplicate. NameToInfo holds the last one, which
+            # is what getinfo() returns, like in zipfile.
+            return self.index.info(i)
+        x = self.NameToInfo.get(name, None)
+        if x is None:
+            x = self.index.info(i)
+            self.NameToInfo[name] = x
+        return x
+
+    def getinfo(self, name):
+        i = self.index.find(name)
+        if i is None:
+            raise KeyError(f"There is no item named {name!r} in the archive")
+        return self.info_at(i)
+
+    def namelist(self):
+        return list(self.index.names)
+
+    def infolist(self):
+        return [self.info_at(i) for i in range(len(self.index))]
+
+    def extent(self, name):
+        # Where the member is stored, see ZipIndex.extent()
+        return self.index.extent(self.index.find(name))
+
+    def tree(self, prefix):
+        # ZipInfo for every member whose name starts with prefix
+        lo, hi = self.index.prefix(prefix)
+        return [self.info_at(i) for i in range(lo, hi)]
@@ -0,0 +1,439 @@
+#!/usr/bin/env python3
+# SPDX-License-Identifier: MIT
+#
+# Benchmark for src/urlcache.py against a local range server that can
+# misbehave like real CDNs do. Runs anywhere with Python 3 and no network.
+#
+#   tools/urlcache_bench.py --latency 0.03 --rate 20M --reset 0.01
+#   tools/urlcache_bench.py --trace small --save-trace /tmp/small.trace
+#   tools/urlcache_bench.py --replay /tmp/small.trace --redirect
+import argparse, io, os, sys, time, random, socket, struct, threading, zipfile, logging, contextlib
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+import urlcache, zipindex
+from util import PackageInstaller
+
+def parse_size(v):
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    v = v.upper().rstrip("B").rstrip("I")
+    if v and v[-1] in units:
+        return int(float(v[:-1]) * units[v[-1]])
+    return int(v)
+
+class Faults:
+    latency = 0         # seconds before each response
+    rate = 0            # bytes/s per connection, 0 = unlimited
+    reset = 0           # probability of an RST in the middle of a body
+    truncate = 0        # probability of a short body and a clean close
+    stall = 0           # probability of a STALL_TIME stall before a body
+    stall_time = 5
+    redirect = False    # serve the corpus behind a 302
+    no_range = False    # ignore Range, always send the whole file
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+            self.resets = 0
+            self.truncated = 0
+
+    def add(self, **kw):
+        with self.lock:
+            for k, v in kw.items():
+                setattr(self, k, getattr(self, k) + v)
+
+class RangeHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    root = None
+    faults = Faults()
+    stats = Stats()
+
+    def setup(self):
+        super().setup()
+        # Otherwise Nagle and delayed ACKs add 40ms to small responses
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.stats.add(requests=1)
+        path = self.path.split("?")[0]
+        if self.faults.redirect and not path.startswith("/real/"):
+            self.send_response(302)
+            self.send_header("Location", "/real" + path)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if path.startswith("/real/"):
+            path = path[5:]
+
+        fn = os.path.join(self.root, os.path.basename(path))
+        if not os.path.isfile(fn):
+            self.send_error(404)
+            return
+        size = os.path.getsize(fn)
+        etag = '"%x-%x"' % (int(os.path.getmtime(fn)), size)
+
+        if self.faults.latency:
+            time.sleep(self.faults.latency)
+
+        ranges = self.parse_range(size)
+        if ranges is None:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        if self.headers.get("If-Range", etag) != etag or self.faults.no_range:
+            ranges = []
+
+        with open(fn, "rb") as fd:
+            if not ranges:
+                self.send_response(200)
+                self.send_header("Content-Length", str(size))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.send_body(fd, [(0, size)])
+            elif len(ranges) == 1:
+                start, end = ranges[0]
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+                self.send_header("Content-Length", str(end - start))
+                self.send_header("ETag", etag)
+                self.end_headers()
+                self.send_body(fd, ranges)
+            else:
+                self.send_multipart(fd, ranges, size, etag)
+
+    def parse_range(self, size):
+        hdr = self.headers.get("Range", None)
+        if not hdr or not hdr.startswith("bytes="):
+            return []
+        ranges = []
+        for part in hdr[6:].split(","):
+            start, end = part.strip().split("-")
+            if start == "":
+                start, end = max(0, size - int(end)), size
+            else:
+                start, end = int(start), min(size, int(end) + 1 if end else size)
+            if start >= end:
+                return None
+            ranges.append((start, end))
+        return ranges
+
+    def send_multipart(self, fd, ranges, size, etag):
+        boundary = "BENCHBOUNDARY"
+        parts = []
+        for start, end in ranges:
+            fd.seek(start)
+            parts.append(f"--{boundary}\r\nContent-Type: application/octet-stream\r\n"
+                         f"Content-Range: bytes {start}-{end - 1}/{size}\r\n\r\n".encode())
+            parts.append(fd.read(end - start))
+            parts.append(b"\r\n")
+        parts.append(f"--{boundary}--\r\n".encode())
+        body = b"".join(parts)
+        self.send_response(206)
+        self.send_header("Content-Type", f"multipart/byteranges; boundary={boundary}")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("ETag", etag)
+        self.end_headers()
+        self.send_body(io.BytesIO(body), [(0, len(body))])
+
+    def send_body(self, fd, ranges):
+        total = sum(end - start for start, end in ranges)
+        cut = None
+        kind = None
+        r = random.random()
+        if r < self.faults.reset:
+            kind = "reset"
+        elif r < self.faults.reset + self.faults.truncate:
+            kind = "truncate"
+        if kind:
+            cut = random.randrange(total) if total else 0
+        if self.faults.stall and random.random() < self.faults.stall:
+            time.sleep(self.faults.stall_time)
+
+        sent = 0
+        t0 = time.time()
+        for start, end in ranges:
+            fd.seek(start)
+            left = end - start
+            while left:
+                n = min(left, 64 * 1024)
+                if cut is not None:
+                    n = min(n, cut - sent)
+                data = fd.read(n)
+                try:
+                    self.wfile.write(data)
+                except OSError:
+                    return
+                sent += len(data)
+                left -= len(data)
+                self.stats.add(bytes=len(data))
+                if cut is not None and sent >= cut:
+                    self.abort(kind)
+                    return
+                if self.faults.rate:
+                    delay = t0 + sent / self.faults.rate - time.time()
+                    if delay > 0:
+                        time.sleep(delay)
+
+    def abort(self, kind):
+        self.close_connection = True
+        try:
+            self.wfile.flush()
+            if kind == "reset":
+                self.stats.add(resets=1)
+                self.connection.setsockopt(socket.SOL_SOCKET, socket.SO_LINGER,
+                                           struct.pack("ii", 1, 0))
+            else:
+                self.stats.add(truncated=1)
+                self.connection.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+def start_server(root, faults):
+    handler = type("Handler", (RangeHandler,), {"root": root, "faults": faults, "stats": Stats()})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, handler.stats
+
+def make_corpus(workdir, big_size, small_count):
+    # An IPSW-like zip: many small compressible members around one large
+    # stored image, like the restore ramdisks and firmware around the OS
+    name = f"bench-{big_size}-{small_count}.zip"
+    path = os.path.join(workdir, name)
+    if os.path.exists(path):
+        return name
+    os.makedirs(workdir, exist_ok=True)
+    rnd = random.Random(0)
+    pattern = rnd.randbytes(4 << 20)
+    tmp = path + ".tmp"
+    with zipfile.ZipFile(tmp, "w") as zf:
+        def small(i):
+            text = "".join(f"<key>k{j}</key><string>{rnd.random()}</string>\n"
+                           for j in range(rnd.randrange(4, 400)))
+            zf.writestr(f"Firmware/dir{i % 37}/file{i}.plist", text, zipfile.ZIP_DEFLATED)
+
+        for i in range(small_count // 2):
+            small(i)
+        info = zipfile.ZipInfo("big.img")
+        info.compress_type = zipfile.ZIP_STORED
+        with zf.open(info, "w", force_zip64=True) as fd:
+            left = big_size
+            while left:
+                n = min(left, len(pattern))
+                fd.write(struct.pack("<Q", left) + pattern[8:n] if n >= 8 else pattern[:n])
+                left -= n
+        for i in range(small_count // 2, small_count):
+            small(i)
+    os.rename(tmp, path)
+    return name
+
+class Recorder(io.RawIOBase):
+    # Wraps a URLCache, recording every read as (offset, size, seconds)
+    def __init__(self, ucache):
+        super().__init__()
+        self.ucache = ucache
+        self.reads = []
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        return self.ucache.seek(offset, whence)
+
+    def tell(self):
+        return self.ucache.tell()
+
+    def read(self, count=-1):
+        off = self.ucache.tell()
+        t0 = time.time()
+        data = self.ucache.read(count)
+        self.reads.append((off, len(data), time.time() - t0))
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+def trace_open(zf, pi, args):
+    zf.infolist()
+
+def trace_stream(zf, pi, args):
+    with zf.open("big.img") as fd:
+        while fd.read(1 << 20):
+            pass
+
+def trace_small(zf, pi, args):
+    infos = [i for i in zf.infolist() if i.filename.startswith("Firmware/")]
+    infos = random.Random(1).sample(infos, min(len(infos), args.small_reads))
+    infos.sort(key=lambda i: i.header_offset)
+    pi.prefetch_infos(infos)
+    for info in infos:
+        zf.read(info)
+
+def trace_random(zf, pi, args):
+    rnd = random.Random(2)
+    size = zf.fp.ucache.size
+    for i in range(args.random_reads):
+        zf.fp.seek(rnd.randrange(size))
+        zf.fp.read(rnd.choice((512, 4096, 65536, 1 << 20)))
+
+TRACES = {
+    "open": trace_open,
+    "stream": trace_stream,
+    "small": trace_small,
+    "random": trace_random,
+}
+
+def replay(rec, path):
+    with open(path) as fd:
+        for line in fd:
+            if not line.strip() or line.startswith("#"):
+                continue
+            off, size = line.split()[:2]
+            rec.seek(int(off))
+            rec.read(int(size))
+
+def union(reads):
+    total = 0
+    end = 0
+    for off, size, t in sorted(reads):
+        if off + size > end:
+            total += off + size - max(off, end)
+            end = off + size
+    return total
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+def run(name, url, stats, args):
+    urlcache.connection_pool.close_idle(urlcache.parse.urlparse(url))
+    urlcache.redirect_cache.clear()
+    stats.reset()
+
+    t0 = time.time()
+    error = None
+    rec = None
+    ucache = None
+    with contextlib.redirect_stdout(io.StringIO()):
+        try:
+            ucache = urlcache.URLCache(url, connections=args.connections, cache_dir=args.cache_dir)
+            rec = Recorder(ucache)
+            if name.startswith("replay:"):
+                replay(rec, name[7:])
+            else:
+                zf = zipindex.IndexedZipFile(rec)
+                pi = PackageInstaller()
+                pi.ucache = ucache
+                pi.pkg = zf
+                TRACES[name](zf, pi, args)
+        except Exception as e:
+            error = e
+        finally:
+            if ucache is not None:
+                ucache.close()
+    elapsed = time.time() - t0
+
+    if args.save_trace and rec is not None:
+        with open(args.save_trace, "a") as fd:
+            fd.write(f"# {name}\n")
+            for off, size, t in rec.reads:
+                fd.write(f"{off} {size}\n")
+
+    reads = rec.reads if rec else []
+    consumed = sum(size for off, size, t in reads)
+    needed = union(reads)
+    lat = [t for off, size, t in reads]
+    return {
+        "trace": name,
+        "error": error,
+        "time": elapsed,
+        "consumed": consumed,
+        "requests": stats.requests,
+        "served": stats.bytes,
+        "overfetch": stats.bytes - needed,
+        "resets": stats.resets + stats.truncated,
+        "p50": percentile(lat, 0.5),
+        "p99": percentile(lat, 0.99),
+        "reads": len(reads),
+    }
+
+def report(results):
+    print(f"{'trace':<10} {'time':>8} {'MB/s':>8} {'reads':>7} {'reqs':>6} {'served MB':>10} "
+          f"{'over MB':>8} {'faults':>6} {'p50 ms':>8} {'p99 ms':>8}")
+    for r in results:
+        if r["error"] is not None:
+            print(f"{r['trace']:<10} FAILED after {r['time']:.2f}s: {r['error']}")
+            continue
+        mbps = r["consumed"] / r["time"] / 1e6 if r["time"] else 0
+        print(f"{r['trace']:<10} {r['time']:8.2f} {mbps:8.1f} {r['reads']:7d} {r['requests']:6d} "
+              f"{r['served'] / 1e6:10.2f} {r['overfetch'] / 1e6:8.2f} {r['resets']:6d} "
+              f"{r['p50'] * 1000:8.2f} {r['p99'] * 1000:8.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="URLCache benchmark against a local range server")
+    parser.add_argument("--workdir", default="/tmp/urlcache-bench")
+    parser.add_argument("--big-size", type=parse_size, default=parse_size("512M"),
+                        help="size of the stored member, e.g. 4G")
+    parser.add_argument("--small-count", type=int, default=2000)
+    parser.add_argument("--small-reads", type=int, default=500)
+    parser.add_argument("--random-reads", type=int, default=200)
+    parser.add_argument("--trace", default="open,small,random,stream",
+                        help=f"comma separated, from {','.join(TRACES)}")
+    parser.add_argument("--replay", action="append", default=[],
+                        help="replay a trace file of 'offset size' lines")
+    parser.add_argument("--save-trace", help="append the recorded reads to this file")
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--connections", type=int, default=None)
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--latency", type=float, default=0, help="seconds per response")
+    parser.add_argument("--rate", type=parse_size, default=0, help="bytes/s per connection")
+    parser.add_argument("--reset", type=float, default=0, help="probability of RST per response")
+    parser.add_argument("--truncate", type=float, default=0, help="probability of a short body")
+    parser.add_argument("--stall", type=float, default=0, help="probability of a stall")
+    parser.add_argument("--stall-time", type=float, default=5)
+    parser.add_argument("--redirect", action="store_true", help="serve behind a 302")
+    parser.add_argument("--no-range", action="store_true", help="ignore Range headers")
+    parser.add_argument("-v", "--verbose", action="store_true")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    name = make_corpus(args.workdir, args.big_size, args.small_count)
+    faults = Faults()
+    for k in ("latency", "rate", "reset", "truncate", "stall", "stall_time", "redirect", "no_range"):
+        setattr(faults, k, getattr(args, k))
+    server, stats = start_server(args.workdir, faults)
+    url = f"http://127.0.0.1:{server.server_address[1]}/{name}"
+
+    traces = [t for t in args.trace.split(",") if t] + [f"replay:{p}" for p in args.replay]
+    for t in traces:
+        if t not in TRACES and not t.startswith("replay:"):
+            parser.error(f"Unknown trace {t}")
+
+    results = []
+    for i in range(args.repeat):
+        for t in traces:
+            results.append(run(t, url, stats, args))
+    report(results)
+    server.shutdown()
+
+if __name__ == "__main__":
+    main()